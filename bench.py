@@ -0,0 +1,526 @@
+#!/usr/bin/env python3
+
+# Times the client's stages against synthetic data, with no terminal or database needed:
+#   ./bench.py --rows 5000 --stations 3 --live 0.5
+# Results are appended to bench_history.jsonl, and compared against the last run from a different commit
+
+import argparse, datetime, gc, json, os, re, subprocess, sys, threading, time, tracemalloc
+from collections import Counter, OrderedDict
+from random import Random
+
+import curses
+
+import client_curses as cc
+import queries
+
+# Column path -> position in a raw board/service row
+POSITIONS = dict(cc.ROW_COLUMNS)
+ROW_WIDTH = max(POSITIONS.values()) + 1
+
+CATEGORIES = ["OO", "OO", "OO", "XX", "EE", "OU", "BR"]
+OPERATORS = ["VT", "GR", "LM", "SN", "TL", "CS", "XR", "GW"]
+POWER_TYPES = ["EMU", "EMU", "DMU", "HST", "E", "D"]
+# The paging stage splits the board's window into this many
+PAGED_SEGMENTS = 4
+# Station iids are 1.., everything else a service calls at comes from here
+OTHER_LOCATIONS = range(1000, 3000)
+
+def departs(row):
+    return row[POSITIONS["departure_scheduled"]] or row[POSITIONS["pass_scheduled"]]
+
+def station_code(n):
+    return "S{:02d}".format(n)
+
+def synthetic_rows(count, stations=1, live=0.5, start=0, duration=120, seed=0):
+    # Raw rows laid out like the board SELECT, spread over the stations and the window and ordered by departure
+    random = Random(seed)
+    rows = []
+    for i in range(count):
+        row = [None]*ROW_WIDTH
+        def put(path, value):
+            row[POSITIONS[path]] = value
+        # Schedule times are on the minute or half minute
+        departure = start + 30*random.randrange(duration*2)
+        passing = random.random() < 0.1
+        if passing:
+            put("pass_scheduled", departure)
+        else:
+            put("arrival_scheduled", departure - 30*random.randrange(5))
+            put("departure_scheduled", departure)
+            put("arrival_public", departure)
+            put("departure_public", departure)
+        put("platform", "{:<3}".format(random.randrange(1, 16)))
+        put("activity", "T ")
+        put("service/uid", "C{:05d}".format(i))
+        put("service/category", random.choice(CATEGORIES))
+        put("service/signalling_id", "{}{}{:02d}".format(random.randrange(1, 10), random.choice("ABCDGH"), random.randrange(100)))
+        put("service/power_type", random.choice(POWER_TYPES))
+        put("service/speed", random.choice([75, 100, 110, 125]))
+        put("service/operating_characteristics", random.choice(["      ", "Q     ", "D     "]))
+        put("service/atoc_code", random.choice(OPERATORS))
+        put("service/date", datetime.date.fromtimestamp(start or time.time()))
+        put("service/iid", 100000+i)
+        put("here", 1 + i%stations)
+        put("origin", random.choice(OTHER_LOCATIONS))
+        put("destination", random.choice(OTHER_LOCATIONS))
+        if random.random() < live:
+            late = 60*random.randrange(-1, 10)
+            put("departure_actual", departure + late)
+            put("trust_departure/platform", row[POSITIONS["platform"]].strip())
+            put("trust_departure/variation_status", "L" if late > 0 else "E" if late < 0 else "T")
+            put("trust_departure/variation", abs(late)//60)
+            put("trust_departure/source", "A")
+            put("service/actual_signalling_id", row[POSITIONS["service/signalling_id"]])
+            put("service/current_variation", late//60)
+            put("last_location", 1 + i%stations)
+        rows.append(tuple(row))
+    rows.sort(key=departs)
+    return rows
+
+def synthetic_times(count, start, seed=0):
+    # Time columns as a day of boards has them: schedule times on the half minute, actuals on the minute, and gaps
+    random = Random(seed)
+    times = []
+    for _ in range(count):
+        kind = random.random()
+        if kind < 0.2:
+            times.append(None)
+        elif kind < 0.7:
+            times.append(start + 30*random.randrange(2*24*60))
+        else:
+            times.append(start + 60*random.randrange(24*60))
+    return times
+
+def synthetic_delta(rows, seed=0):
+    # What the next poll would bring in: another movement for some of the live rows
+    random = Random(seed)
+    movements, schedules = [], []
+    for row in rows:
+        if row[POSITIONS["departure_actual"]] and random.random() < 0.3:
+            iid = row[POSITIONS["service/iid"]]
+            scheduled = departs(row)
+            movements.append((iid, "D", scheduled, scheduled + 60*random.randrange(10), "1", None, None, "L", 3, None, "A"))
+            schedules.append((iid, row[POSITIONS["service/signalling_id"]], 3))
+    return movements, schedules
+
+class CannedCursor():
+    # Enough of a psycopg2 cursor for queries.execute and everything that reads from one
+    def __init__(self, connection):
+        self.connection = connection
+        self.rows = []
+        self.itersize = 2000
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def execute(self, sql, args=None):
+        prepare = re.match(r"PREPARE (\w+) AS (.*);$", sql, re.S)
+        if prepare:
+            self.connection.prepared[prepare.group(1)] = prepare.group(2)
+            self.rows = []
+            return
+        execute = re.match(r"EXECUTE (\w+)\(", sql)
+        if execute:
+            sql = self.connection.prepared[execute.group(1)]
+        self.connection.executed += 1
+        self.rows = self.connection.respond(sql, args)
+
+    def fetchall(self):
+        return list(self.rows)
+
+    def fetchone(self):
+        return next(iter(self.rows), None)
+
+    def __iter__(self):
+        return iter(self.rows)
+
+class CannedConnection():
+    def __init__(self, respond):
+        self.respond = respond
+        self.prepared = {}
+        self.executed = 0
+        self.closed = 0
+
+    def cursor(self, name=None):
+        return CannedCursor(self)
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        self.closed = 1
+
+class CannedPool(queries.ConnectionPool):
+    def __init__(self, respond):
+        super(CannedPool, self).__init__(None, 2)
+        self.respond = respond
+
+    def connect(self):
+        return CannedConnection(self.respond)
+
+class CannedDatabase():
+    # Answers each of the client's queries from the synthetic rows
+    def __init__(self, rows, delta):
+        self.rows, self.delta = rows, delta
+        self.by_station, self.by_service = {}, {}
+        self.span = (min(map(departs, rows), default=0), max(map(departs, rows), default=0))
+        for row in rows:
+            self.by_station.setdefault(row[POSITIONS["here"]], []).append(row)
+            self.by_service.setdefault(cc.service_key(row), []).append(row)
+
+    def __call__(self, sql, args):
+        if "FROM locations WHERE iid=ANY" in sql:
+            return [(iid, "TIP{}".format(iid), "STATION {}".format(iid), str(70000+iid), None) for iid in args[0]]
+        if "FROM locations WHERE crs=" in sql:
+            return [(int(args[0][1:]),)]
+        if "FROM trust_movements" in sql and "flat_timing" not in sql:
+            return self.delta[0]
+        if "FROM flat_schedules WHERE" in sql:
+            return self.delta[1]
+        if "unnest" in sql:
+            return [row for service in zip(*args[:2]) for row in self.by_service.get(service, [])]
+        if "flat_timing" in sql:
+            stations = args[0] if isinstance(args[0], list) else [args[0]]
+            # main_loop's trjd asks about now, which the rows aren't, so a window that misses them all gets the lot
+            earliest, latest = self.span
+            start, end = (args[1], args[2]) if args[1] <= latest and args[2] >= earliest else self.span
+            return sorted((row for station in stations for row in self.by_station.get(station, []) if start <= departs(row) <= end), key=departs)
+        return []
+
+class FakeWindow():
+    # Counts what would have gone to the terminal
+    def __init__(self, lines, cols):
+        self.lines, self.cols = lines, cols
+        self.calls = Counter()
+        self.chars = 0
+
+    def addstr(self, y, x, text, attr=0):
+        self.calls["addstr"] += 1
+        self.chars += len(text)
+
+    def hline(self, y, x, ch, n):
+        self.calls["hline"] += 1
+        self.chars += n
+
+    def getmaxyx(self):
+        return self.lines, self.cols
+
+    def resize(self, lines, cols):
+        self.lines, self.cols = lines, cols
+
+    def __getattr__(self, name):
+        # move, clrtoeol, erase, noutrefresh and the like
+        def call(*args):
+            self.calls[name] += 1
+        return call
+
+class FakeScreen(FakeWindow):
+    # stdscr, with keypresses from a script. None waits for background refreshes to finish, which isn't counted
+    def __init__(self, lines, cols, keys):
+        super(FakeScreen, self).__init__(lines, cols)
+        self.keys = list(keys)
+        self.frames, self.waited = 0, 0.0
+
+    def getch(self):
+        self.frames += 1
+        while self.keys and self.keys[0] is None:
+            self.keys.pop(0)
+            start = time.perf_counter()
+            settle()
+            self.waited += time.perf_counter()-start
+        return self.keys.pop(0) if self.keys else ord("q")
+
+class FakeCurses():
+    # Stands in for the curses module inside client_curses, anything not here is the real constant
+    def __init__(self, screen):
+        self.screen = screen
+        self.LINES, self.COLS = screen.lines, screen.cols
+        self.ACS_BULLET, self.ACS_VLINE = ord("."), ord("|")
+        self.windows = [screen]
+
+    def __getattr__(self, name):
+        value = getattr(curses, name)
+        if callable(value) and not isinstance(value, type):
+            return lambda *args: None
+        return value
+
+    def newwin(self, lines, cols, y, x):
+        window = FakeWindow(lines, cols)
+        self.windows.append(window)
+        return window
+
+    def color_pair(self, n):
+        return n << 8
+
+def unloaded(cls):
+    # get_board and get_boards don't touch the buffer, so there's no need for one that's queried already
+    return cls.__new__(cls)
+
+def settle():
+    # Until every background query's finished
+    while threading.active_count() > 1:
+        time.sleep(0.001)
+
+def keystrokes(text):
+    return [ord(c) for c in text]
+
+class Bench():
+    def __init__(self, args):
+        self.args = args
+        self.start = int(datetime.datetime(2024, 1, 1, 6, 0).timestamp())
+        self.rows = synthetic_rows(args.rows, args.stations, args.live, self.start, args.duration, args.seed)
+        self.delta = synthetic_delta(self.rows, args.seed)
+        self.database = CannedDatabase(self.rows, self.delta)
+        self.stations = [station_code(n) for n in range(1, args.stations+1)]
+        self.results = OrderedDict()
+
+    def reset(self):
+        # Every stage starts cold, as a newly started client would
+        queries.pool = CannedPool(self.database)
+        queries.crs_iids.clear()
+        cc.location_cache.locations.clear()
+        cc.location_cache.fresh.clear()
+        cc.process_time.memo.clear()
+        cc.process_time.quarters.clear()
+        cc.column_plan_cache.clear()
+        cc.snapshots = cc.SnapshotCache(16, 30)
+        cc.prefetched = cc.SnapshotCache(64, 120)
+        cc.segments = cc.SnapshotCache(8, 120)
+
+    def board(self, duration=None):
+        # A board for the first station with its data already in, so constructing it doesn't start a refresh
+        duration = duration or self.args.duration
+        dt_start = datetime.datetime.fromtimestamp(self.start)
+        data = unloaded(cc.BoardBuffer).get_board(dt_start, duration, self.stations[0])
+        cc.snapshots.put(("board", self.stations[0], duration), data, (dt_start, 0, 0))
+        return cc.BoardBuffer(dt_start, duration, self.stations[0])
+
+    def stage(self, name, setup, run):
+        # run(state) is timed on its own, best of the repeats, then run once more under tracemalloc
+        best, extra = None, {}
+        for _ in range(self.args.repeat):
+            self.reset()
+            state = setup()
+            gc.collect()
+            start = time.perf_counter()
+            extra = run(state) or {}
+            elapsed = time.perf_counter()-start
+            best = elapsed if best is None else min(best, elapsed)
+        self.reset()
+        state = setup()
+        gc.collect()
+        tracemalloc.start()
+        run(state)
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        self.results[name] = OrderedDict([("ms", round(best*1000, 3)), ("kept_kb", round(current/1024, 1)), ("peak_kb", round(peak/1024, 1))])
+        self.results[name].update(extra)
+
+    def run(self):
+        # Rendering asks curses for colours and line drawing characters, which needs a terminal
+        real, cc.curses = cc.curses, FakeCurses(FakeScreen(self.args.lines, self.args.cols, []))
+        try:
+            return self.stages()
+        finally:
+            cc.curses = real
+
+    def startup(self):
+        # A fresh interpreter each time, since a module's only ever imported once. -X importtime gives microseconds per module
+        # It's timed with the bytecode already cached, as it would be after the first ever start
+        env = dict(os.environ)
+        env.pop("PYTHONDONTWRITEBYTECODE", None)
+        command = [sys.executable, "-X", "importtime", "-c", "import client_curses"]
+        here = os.path.dirname(os.path.abspath(__file__))
+        subprocess.run(command, cwd=here, env=env, capture_output=True, check=True)
+        best, heaviest = None, []
+        for _ in range(self.args.repeat):
+            stderr = subprocess.run(command, cwd=here, env=env, capture_output=True, text=True, check=True).stderr
+            modules = []
+            for line in stderr.splitlines():
+                match = re.match(r"import time:\s+(\d+) \|\s+(\d+) \|\s+(.*)", line)
+                if match:
+                    modules.append((int(match.group(1)), int(match.group(2)), match.group(3).strip()))
+            total = next(cumulative for own, cumulative, name in modules if name == "client_curses")
+            if best is None or total < best:
+                best, heaviest = total, sorted(modules, reverse=True)[:3]
+        self.results["import"] = OrderedDict([("ms", round(best/1000, 3)), ("kept_kb", 0.0), ("peak_kb", 0.0)])
+        self.results["import"]["heaviest"] = ",".join("{}:{:.1f}".format(name, own/1000) for own, cumulative, name in heaviest)
+
+    def stages(self):
+        args = self.args
+        self.startup()
+        cc.config.update({"data-backend": args.backend, "push-refresh": False, "delta-refresh": True})
+        station = self.stations[0]
+        station_rows = [row for row in self.rows if row[POSITIONS["here"]] == 1]
+
+        self.stage("decode", lambda: station_rows,
+            lambda rows: {"rows": len(cc.decode_rows(cc.BOARD_SCHEMA, rows).data)})
+
+        # process_time a value at a time as decode_row does, and a column at a time as decode_rows does first
+        times = synthetic_times(args.times, self.start, args.seed)
+        def time_memo(times):
+            for unix_time in times:
+                cc.process_time(unix_time)
+            return {"times": len(times), "distinct": len(set(times))}
+        self.stage("time_memo", lambda: times, time_memo)
+        def time_batch(times):
+            cc.process_time.batch(times)
+            return time_memo(times)
+        self.stage("time_batch", lambda: times, time_batch)
+        # Nothing repeats, so it's all down to the batch path
+        self.stage("time_distinct", lambda: range(self.start, self.start+7*args.times, 7), time_batch)
+
+        self.stage("get_board", lambda: datetime.datetime.fromtimestamp(self.start),
+            lambda dt_start: {"rows": len(unloaded(cc.BoardBuffer).get_board(dt_start, args.duration, station).data)})
+
+        self.stage("renew", self.board, lambda board: board.renew())
+
+        def first_paint(board):
+            window = cc.FrameWindow(FakeWindow(args.lines, args.cols))
+            board.render(window, args.lines, args.cols)
+            return {"calls": window.calls, "chars": window.window.chars}
+        self.stage("first_paint", self.board, first_paint)
+
+        def scroll_setup():
+            board = self.board()
+            window = cc.FrameWindow(FakeWindow(args.lines, args.cols))
+            board.render(window, args.lines, args.cols)
+            window.calls, window.window.chars = 0, 0
+            return board, window
+        def scroll(state):
+            board, window = state
+            for _ in range(args.frames):
+                board.move_selection(1, args.lines)
+                board.render(window, args.lines, args.cols)
+            return {"calls_per_frame": round(window.calls/args.frames, 1), "chars_per_frame": round(window.window.chars/args.frames, 1)}
+        self.stage("scroll", scroll_setup, scroll)
+
+        def delta(board):
+            board.apply(board.get_delta(board.data.data, board.watermark))
+            return {"movements": len(self.delta[0])}
+        self.stage("delta", self.board, delta)
+
+        def paging_setup():
+            # The same rows, but as a board of PAGED_SEGMENTS shorter windows
+            board = self.board(args.duration//PAGED_SEGMENTS)
+            window = cc.FrameWindow(FakeWindow(args.lines, args.cols))
+            board.render(window, args.lines, args.cols)
+            return board, window
+        def paging(state):
+            board, window = state
+            pages = stalls = 0
+            while board.last < PAGED_SEGMENTS-1:
+                # A moment reading the screen, which is when the next segment's prefetched
+                board.prefetch_segments()
+                settle()
+                last = board.last
+                board.move_selection(args.lines, args.lines)
+                if board.pending:
+                    stalls += 1
+                    settle()
+                    board.consider_refresh()
+                pages += board.last > last
+                board.render(window, args.lines, args.cols)
+            return {"pages": pages, "stalls": stalls, "rows": len(board.lines)}
+        self.stage("paging", paging_setup, paging)
+
+        if len(self.stations) > 1:
+            def split(dt_start):
+                return {"rows": sum(len(data.data) for data in unloaded(cc.SplitBoardBuffer).get_boards(dt_start, args.duration, self.stations).data)}
+            self.stage("get_boards", lambda: datetime.datetime.fromtimestamp(self.start), split)
+
+        def first_screen(fake):
+            # Up to the first frame being drawn, which is when the listener and the pool's first connection get going
+            real, cc.curses = cc.curses, fake
+            try:
+                cc.main(fake.screen)
+            finally:
+                cc.curses = real
+        self.stage("first_screen", lambda: FakeCurses(FakeScreen(args.lines+3, args.cols, [])), first_screen)
+
+        def main_loop(fake):
+            real, cc.curses = cc.curses, fake
+            try:
+                cc.main(fake.screen)
+            finally:
+                cc.curses = real
+            calls = sum(sum(window.calls.values()) for window in fake.windows)
+            return {"frames": fake.screen.frames, "calls_per_frame": round(calls/fake.screen.frames, 1), "waited_ms": round(fake.screen.waited*1000, 1)}
+        command = "trjd " + " ".join(self.stations)
+        keys = keystrokes(":" + command + "\n") + [None] + [curses.KEY_DOWN]*args.frames + [-1]*5 + [None]
+        self.stage("main_loop", lambda: FakeCurses(FakeScreen(args.lines+3, args.cols, keys)), main_loop)
+        return self.results
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def previous_run(path, params, commit):
+    # Latest run with the same parameters from some other commit
+    try:
+        with open(path) as f:
+            runs = [json.loads(line) for line in f if line.strip()]
+    except FileNotFoundError:
+        return None
+    for run in reversed(runs):
+        if run["params"] == params and run["commit"] != commit:
+            return run
+
+def report(results, previous, threshold):
+    regressions = []
+    print("{:<12} {:>10} {:>10} {:>10} {:>9}  {}".format("stage", "ms", "kept kB", "peak kB", "vs prev", "other"))
+    for name, result in results.items():
+        change = ""
+        before = previous and previous["results"].get(name)
+        if before and before["ms"]:
+            ratio = result["ms"]/before["ms"] - 1
+            change = "{:+.0%}".format(ratio)
+            if ratio > threshold:
+                regressions.append(name)
+                change += "!"
+        other = " ".join("{}={}".format(k, v) for k,v in result.items() if k not in ("ms", "kept_kb", "peak_kb"))
+        print("{:<12} {:>10.2f} {:>10.1f} {:>10.1f} {:>9}  {}".format(name, result["ms"], result["kept_kb"], result["peak_kb"], change, other))
+    if previous:
+        print("compared with {} from {}".format(previous["commit"], previous["when"]))
+    if regressions:
+        print("slower by more than {:.0%}: {}".format(threshold, ", ".join(regressions)))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the client against synthetic boards")
+    parser.add_argument("--rows", type=int, default=5000, help="rows across all stations")
+    parser.add_argument("--stations", type=int, default=1)
+    parser.add_argument("--live", type=float, default=0.5, help="fraction of rows with live running data")
+    parser.add_argument("--duration", type=int, default=120, help="board window in minutes")
+    parser.add_argument("--backend", choices=["records", "columnar"], default="records")
+    parser.add_argument("--lines", type=int, default=50, help="body height of the fake terminal")
+    parser.add_argument("--cols", type=int, default=200)
+    parser.add_argument("--times", type=int, default=50000, help="timestamps in the time formatting stages")
+    parser.add_argument("--frames", type=int, default=100, help="frames of scrolling in the scroll and main_loop stages")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--history", default="bench_history.jsonl")
+    parser.add_argument("--no-history", action="store_true", help="don't record this run")
+    parser.add_argument("--threshold", type=float, default=0.2, help="slowdown flagged as a regression")
+    parser.add_argument("--check", action="store_true", help="exit non-zero on a regression")
+    args = parser.parse_args()
+
+    params = OrderedDict((k, getattr(args, k)) for k in ["rows", "stations", "live", "duration", "backend", "lines", "cols", "frames", "times"])
+    commit = git_commit()
+    results = Bench(args).run()
+    regressions = report(results, previous_run(args.history, params, commit), args.threshold)
+
+    if not args.no_history:
+        with open(args.history, "a") as f:
+            f.write(json.dumps(OrderedDict([("commit", commit), ("when", datetime.datetime.now().isoformat(timespec="seconds")),
+                ("params", params), ("results", results)])) + "\n")
+    if args.check and regressions:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -1,21 +1,124 @@
 #!/usr/bin/env python3
 
-import datetime, sys
-from collections import OrderedDict
-
-import psycopg2, psycopg2.extras
-import curses
-
-from common import database
-
-def process_time(unix_time):
-    out = OrderedDict([("ut",None), ("iso", None), ("date", None), ("short", "")])
-    if unix_time:
+import datetime, json, os, queue, re, select, sys, threading, time
+from array import array
+from collections import OrderedDict, namedtuple
+from itertools import islice
+from operator import itemgetter
+
+# Only imported once there's a terminal to draw on, export.py gets by without it
+curses = None
+
+import queries
+from queries import config
+
+class Record():
+    # Slotted stand-in for the nested dicts rows used to be, so schema paths and substitute_fn work unchanged
+    __slots__ = []
+    __getitem__ = object.__getattribute__
+    __setitem__ = object.__setattr__
+
+    def __init__(self, *values):
+        for key, value in zip(self.__slots__, values):
+            setattr(self, key, value)
+
+    def keys(self):
+        return self.__slots__
+
+class Time(Record):
+    __slots__ = ["ut", "iso", "date", "short"]
+
+class Movement(Record):
+    __slots__ = ["platform", "line", "route", "variation_status", "variation", "direction", "source"]
+
+class Service(Record):
+    __slots__ = ["uid", "category", "signalling_id", "headcode", "power_type", "timing_load", "speed", "operating_characteristics", "seating_class", "sleepers",
+        "reservations", "catering", "branding", "uic_code", "atoc_code", "date", "actual_signalling_id", "trust_id", "current_variation", "iid"]
+
+class Location(Record):
+    __slots__ = ["tiploc", "name", "stanox", "crs"]
+
+class Row(Record):
+    __slots__ = ["arrival_scheduled", "departure_scheduled", "pass_scheduled", "arrival_actual", "departure_actual",
+        "arrival_public", "departure_public", "platform", "line", "path", "activity", "engineering_allowance", "pathing_allowance", "performance_allowance",
+        "trust_arrival", "trust_departure", "service", "here", "origin", "destination", "last_location", "cancellation_location"]
+
+# Never modified either, so every row at a location shares the one record
+location_cache = queries.LocationCache(Location, config.get("location-ttl", 24*60*60))
+
+# Never modified, so every missing time can share it
+NO_TIME = Time(None, None, None, "")
+
+class TimeFormatter():
+    # unix time -> Time, called like the function it replaced. Schedule times are all on the minute or half
+    # minute, so a board is mostly the same few hundred of them over and over
+    def __init__(self, size):
+        self.size = size
+        self.memo = {}
+        # UTC quarter hour -> local (date, hour, minute) at its start
+        self.quarters = {}
+
+    def __call__(self, unix_time):
+        if not unix_time:
+            return NO_TIME
+        try:
+            return self.memo[unix_time]
+        except KeyError:
+            pass
         dt = datetime.datetime.fromtimestamp(float(unix_time))
-        out["ut"] = unix_time
-        out["iso"] = dt.strftime("%Y-%m-%dT%H:%M:%S")
-        out["date"] = dt.strftime("%Y-%m-%d")
-        out["short"] = dt.strftime("%H%M") + "½"*(dt.second==30)
+        out = Time(unix_time, dt.strftime("%Y-%m-%dT%H:%M:%S"), dt.strftime("%Y-%m-%d"), dt.strftime("%H%M") + "½"*(dt.second==30))
+        if len(self.memo) >= self.size:
+            # Cheaper than keeping it in LRU order on every lookup, and it soon fills back up with what's on screen
+            self.memo.clear()
+        self.memo[unix_time] = out
+        return out
+
+    def quarter(self, q):
+        if q not in self.quarters:
+            if len(self.quarters) >= self.size:
+                self.quarters.clear()
+            dt = datetime.datetime.fromtimestamp(q*900)
+            # Every current UTC offset and DST change is on a quarter hour, so nothing inside one crosses a local hour.
+            # Old LMT offsets aren't, those go the slow way
+            self.quarters[q] = (dt.strftime("%Y-%m-%d"), dt.hour, dt.minute) if dt.minute%15==0 and dt.second==0 else None
+        return self.quarters[q]
+
+    def batch(self, unix_times):
+        # Formats whatever of a column isn't memoised yet with one datetime per quarter hour rather than one per value
+        memo = self.memo
+        missing = {unix_time for unix_time in unix_times if unix_time and unix_time not in memo}
+        if len(memo) + len(missing) > self.size:
+            memo.clear()
+        for unix_time in missing:
+            q, s = divmod(int(float(unix_time)), 900)
+            local = self.quarter(q)
+            if not local:
+                self(unix_time)
+                continue
+            date, hour, minute = local
+            minute += s//60
+            second = s%60
+            memo[unix_time] = Time(unix_time, "%sT%02d:%02d:%02d" % (date, hour, minute, second), date, "%02d%02d" % (hour, minute) + "½"*(second==30))
+
+process_time = TimeFormatter(config.get("time-cache-size", 65536))
+
+def decode_row(row):
+    # Positions are those of the board/service SELECT
+    out = Row()
+    out.arrival_scheduled, out.departure_scheduled, out.pass_scheduled, out.arrival_actual, out.departure_actual = map(process_time, row[0:5])
+    (out.arrival_public, out.departure_public, out.platform, out.line, out.path, out.activity,
+        out.engineering_allowance, out.pathing_allowance, out.performance_allowance) = row[5:14]
+    if out.platform:
+        out.platform = out.platform.rstrip()
+
+    out.trust_arrival = Movement(*row[14:21])
+    out.trust_departure = Movement(*row[21:28])
+
+    out.service = Service(*row[28:47], row[52])
+    out.service.operating_characteristics = out.service.operating_characteristics.rstrip()
+
+    # Only the iids come back, location_cache has to have been given them already
+    out.here, out.origin, out.destination, out.last_location, out.cancellation_location = map(location_cache.get, row[47:52])
     return out
 
 # Python justification is /good/ but it's not quite perfect for this
@@ -35,127 +138,1057 @@ def platform_justify(str, length):
     else:
         return str.ljust(3)
 
+TIME_SCHEMA_SHORT = {
+    "iso":    (None, 19),
+    "short":  (None, 4),
+}
+TIME_SCHEMA = {
+    "iso":    (None, 19),
+    "short":  (None, 5),
+}
+
+LOCATION_SCHEMA = {
+    "name":   (None, 30),
+    "tiploc": (None, 7),
+    "crs":    (None, 3),
+}
+
+BOARD_SCHEMA = {
+    "service": {
+        "uid":                  ("UID", 6, str.rjust),
+        "atoc_code":            ("o.", 2),
+        "power_type":           ("pw.", 3),
+        "category":             ("c.", 2),
+        "signalling_id":        ("sig.", 4),
+        "actual_signalling_id": ("rt.s", 4, None, 3),
+        "current_variation":    ("v.", 3, str.rjust, 3),
+        "operating_characteristics": ("oc.", 4),
+    },
+    "trust_arrival": {
+        "platform": ("pt.", 3, platform_justify),
+    },
+
+    "trust_departure": {
+        "platform": ("pt.", 3, platform_justify),
+    },
+
+    "platform": ("pt.", 3, platform_justify),
+
+    "arrival_scheduled":   {"_": ("arrival",),   **TIME_SCHEMA},
+    "departure_scheduled": {"_": ("departure",), **TIME_SCHEMA},
+    "pass_scheduled":      {"_": ("pass",),      **TIME_SCHEMA},
+
+    "arrival_actual":   {"_": ("arrival",  None, None, 3), **TIME_SCHEMA_SHORT},
+    "departure_actual": {"_": ("departure",None, None, 3), **TIME_SCHEMA_SHORT},
+
+    "origin":      {"_": ("origin",),      **LOCATION_SCHEMA},
+    "destination": {"_": ("destination",), **LOCATION_SCHEMA},
+}
+
+SERVICE_SCHEMA = {
+    "service": {
+        "uid":                  ("UID", 6, str.rjust),
+        "atoc_code":            ("o.", 2),
+        "power_type":           ("pw.", 3),
+        "category":             ("c.", 2),
+        "signalling_id":        ("sig.", 4),
+        "actual_signalling_id": ("rt.s", 4, None, 3),
+        "current_variation":    ("v.", 3, str.rjust, 3),
+        "operating_characteristics": ("oc.", 4),
+    },
+    "trust_arrival": {
+        "platform": ("pt.", 3, platform_justify),
+        "source": ("source", 1),
+    },
+
+    "trust_departure": {
+        "platform": ("pt.", 3, platform_justify),
+        "source": ("source", 1, None, 3),
+    },
+
+    "platform": ("pt.", 3, platform_justify),
+    "activity": ("activity", 12),
+
+    "arrival_scheduled":   {"_": ("arrival",),   **TIME_SCHEMA},
+    "departure_scheduled": {"_": ("departure",), **TIME_SCHEMA},
+    "pass_scheduled":      {"_": ("pass",),      **TIME_SCHEMA},
+
+    "arrival_actual":   {"_": ("arrival",  None, None, 3), **TIME_SCHEMA_SHORT},
+    "departure_actual": {"_": ("departure",None, None, 3), **TIME_SCHEMA_SHORT},
+
+    "here":      {"_": ("location",),      **LOCATION_SCHEMA},
+    "origin":      {"_": ("origin",),      **LOCATION_SCHEMA},
+    "destination": {"_": ("destination",), **LOCATION_SCHEMA},
+}
+
+class NotificationListener():
+    # Ingest NOTIFYs this channel as movements land, see notify.sql
+    def __init__(self, dsn, channel):
+        self.dsn, self.channel = dsn, channel
+        self.notifications = queue.Queue()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        import psycopg2, psycopg2.sql
+        while True:
+            try:
+                connection = psycopg2.connect(self.dsn)
+                connection.autocommit = True
+                with connection.cursor() as c:
+                    c.execute(psycopg2.sql.SQL("LISTEN {};").format(psycopg2.sql.Identifier(self.channel)))
+                    # Anything could have changed while we weren't listening
+                    self.notifications.put(None)
+                    while True:
+                        if select.select([connection], [], [], 60) == ([], [], []):
+                            # Quiet for a while, make sure the server's actually still there
+                            c.execute("SELECT 1;")
+                        connection.poll()
+                        while connection.notifies:
+                            self.notifications.put(self.parse(connection.notifies.pop(0).payload))
+            except psycopg2.Error:
+                time.sleep(5)
+
+    def parse(self, payload):
+        try:
+            payload = json.loads(payload)
+        except ValueError:
+            return None
+        return payload if isinstance(payload, dict) else None
+
+    def drain(self):
+        while True:
+            try:
+                yield self.notifications.get_nowait()
+            except queue.Empty:
+                return
+
+class Timings():
+    # Where the time's going, for the overlay and the timing log. Nothing's collected unless one of them wants it,
+    # so the cost otherwise is checking enabled once per stage
+    def __init__(self, path=None):
+        self.path, self.log = path, None
+        self.overlay = False
+        self.enabled = False
+        self.lock = threading.Lock()
+        # stage -> its fields from the last time it ran
+        self.latest = OrderedDict()
+        self.update()
+
+    def toggle_overlay(self):
+        self.overlay = not self.overlay
+        self.update()
+
+    def update(self):
+        enabled = self.overlay or bool(self.path)
+        if enabled and not self.enabled:
+            queries.query_hooks.append(self.query)
+        elif self.enabled and not enabled:
+            queries.query_hooks.remove(self.query)
+        self.enabled = enabled
+
+    def query(self, name, prepared, seconds):
+        self.record("query", seconds, name=name)
+
+    def record(self, stage, seconds, **fields):
+        fields = OrderedDict([("ms", round(seconds*1000, 2))] + sorted(fields.items()))
+        with self.lock:
+            self.latest[stage] = fields
+            if self.path:
+                if not self.log:
+                    self.log = open(self.path, "a", buffering=1)
+                self.log.write(json.dumps(OrderedDict([("at", round(time.time(), 3)), ("stage", stage)] + list(fields.items())), default=str) + "\n")
+
+    def summary(self):
+        with self.lock:
+            return "  ".join(" ".join([stage, "{}ms".format(fields["ms"])] + ["{}={}".format(k, v) for k,v in fields.items() if k != "ms"])
+                for stage, fields in self.latest.items())
+
+timings = Timings(config.get("timing-log"))
+
 class Data():
     def __init__(self, schema, data):
         self.schema = schema
         self.data = data
 
+# Column path -> position in the board/service SELECT, as decode_row lays it out
+ROW_COLUMNS = ([(tag, i) for i,tag in enumerate(Row.__slots__[:14])]
+    + [("trust_arrival/" + tag, 14+i) for i,tag in enumerate(Movement.__slots__)]
+    + [("trust_departure/" + tag, 21+i) for i,tag in enumerate(Movement.__slots__)]
+    + [("service/" + tag, 28+i) for i,tag in enumerate(Service.__slots__[:-1])] + [("service/iid", 52)]
+    + [(group, 47+j) for j,group in enumerate(Row.__slots__[17:])]
+    )
+ROW_GROUPS = {
+    "trust_arrival": Movement, "trust_departure": Movement, "service": Service,
+    "here": Location, "origin": Location, "destination": Location, "last_location": Location, "cancellation_location": Location,
+}
+TIME_COLUMNS = set(Row.__slots__[:5])
+# Only a handful of distinct values, so they're kept as indices into a table
+CODED_COLUMNS = {"service/category", "service/atoc_code", "service/power_type"}
+STRIPPED_COLUMNS = {"platform", "service/operating_characteristics"}
+# Just the iid is stored, it's looked up in location_cache when read
+LOCATION_COLUMNS = set(Row.__slots__[17:])
+
+class ColumnarData(Data):
+    # Each leaf is its own column rather than each row being its own object, data is a sequence of views over them
+    def __init__(self, schema, rows=()):
+        self.schema = schema
+        self.columns, self.codes, self.interned = {}, {}, {}
+        for path, position in ROW_COLUMNS:
+            if path in TIME_COLUMNS:
+                self.columns[path] = array("q")
+            elif path in CODED_COLUMNS:
+                self.columns[path] = array("H")
+                self.codes[path] = ([], {})
+            else:
+                self.columns[path] = []
+        self.length = 0
+        self.data = ColumnarRows(self)
+        self.extend(rows)
+
+    def intern(self, value):
+        try:
+            return self.interned.setdefault(value, value)
+        except TypeError:
+            return value
+
+    def encode(self, path, value):
+        table, index = self.codes[path]
+        if value not in index:
+            index[value] = len(table)
+            table.append(value)
+        return index[value]
+
+    def store(self, path, value):
+        if path in TIME_COLUMNS:
+            return value or 0
+        if path in STRIPPED_COLUMNS and value:
+            value = value.rstrip()
+        if path in CODED_COLUMNS:
+            return self.encode(path, value)
+        return self.intern(value)
+
+    def append(self, row):
+        for path, position in ROW_COLUMNS:
+            self.columns[path].append(self.store(path, row[position]))
+        # Only once every column has it, so a reader on another thread never sees half a row
+        self.length += 1
+
+    def extend(self, rows):
+        for row in rows:
+            self.append(row)
+
+    def copy_rows(self, other, positions):
+        # Rows from another ColumnarData, already stored so only the coded ones need translating to this one's tables
+        positions = list(positions)
+        # Boards are in time order, so it's nearly always one run of them that can be sliced out
+        run = positions and positions[-1]-positions[0]+1 == len(positions)
+        for path, position in ROW_COLUMNS:
+            column, theirs = self.columns[path], other.columns[path]
+            values = theirs[positions[0]:positions[-1]+1] if run else [theirs[i] for i in positions]
+            if path in CODED_COLUMNS:
+                codes = [self.encode(path, value) for value in other.codes[path][0]]
+                values = [codes[code] for code in values]
+            column.extend(values)
+        self.length += len(positions)
+
+    def get(self, index, path):
+        value = self.columns[path][index]
+        if path in TIME_COLUMNS:
+            return process_time(value)
+        if path in CODED_COLUMNS:
+            return self.codes[path][0][value]
+        if path in LOCATION_COLUMNS:
+            return location_cache.get(value)
+        return value
+
+    def set(self, index, path, value):
+        if path in TIME_COLUMNS:
+            value = value["ut"]
+        self.columns[path][index] = self.store(path, value)
+
+    def __getstate__(self):
+        # Locations are only iids, so what they are goes along too for whoever unpickles it, see SharedSnapshots
+        state = dict(self.__dict__)
+        state["locations"] = {iid: location_cache.locations[iid] for path in LOCATION_COLUMNS for iid in set(self.columns[path]) if iid in location_cache.locations}
+        return state
+
+    def __setstate__(self, state):
+        location_cache.seed(state.pop("locations"))
+        self.__dict__.update(state)
+
+class ColumnarRows():
+    __slots__ = ["data"]
+
+    def __init__(self, data):
+        self.data = data
+
+    def __len__(self):
+        return self.data.length
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [ColumnarRow(self.data, i) for i in range(*index.indices(self.data.length))]
+        if index < 0:
+            index += self.data.length
+        if not 0 <= index < self.data.length:
+            raise IndexError(index)
+        return ColumnarRow(self.data, index)
+
+    def __iter__(self):
+        for i in range(self.data.length):
+            yield ColumnarRow(self.data, i)
+
+class ColumnarRow():
+    __slots__ = ["data", "index", "prefix"]
+
+    def __init__(self, data, index, prefix=""):
+        self.data, self.index, self.prefix = data, index, prefix
+
+    def __getitem__(self, key):
+        if not self.prefix and key in LOCATION_COLUMNS:
+            return self.data.get(self.index, key)
+        if not self.prefix and key in ROW_GROUPS:
+            return ColumnarRow(self.data, self.index, key + "/")
+        return self.data.get(self.index, self.prefix + key)
+
+    def __setitem__(self, key, value):
+        if not self.prefix and key in ROW_GROUPS:
+            for tag in ROW_GROUPS[key].__slots__:
+                self.data.set(self.index, key + "/" + tag, value[tag])
+        else:
+            self.data.set(self.index, self.prefix + key, value)
+
+    def keys(self):
+        return ROW_GROUPS[self.prefix[:-1]].__slots__ if self.prefix else Row.__slots__
+
+def decode_rows(schema, rows, progress=None):
+    # progress gets the Data so far after every batch, it's the same object that's eventually returned
+    columnar = config.get("data-backend") == "columnar"
+    data = ColumnarData(schema) if columnar else Data(schema, [])
+    rows = iter(rows)
+    # Waiting on the cursor and decoding what it gave are timed separately
+    fetching = decoding = 0
+    while True:
+        if timings.enabled:
+            start = time.perf_counter()
+        batch = list(islice(rows, config.get("cursor-itersize", 500)))
+        if timings.enabled:
+            fetched = time.perf_counter()
+            fetching += fetched-start
+        if not batch:
+            if timings.enabled:
+                timings.record("decode", decoding, rows=len(data.data), fetch_ms=round(fetching*1000, 1))
+            return data
+        location_cache.resolve(iid for row in batch for iid in row[47:52])
+        if columnar:
+            data.extend(batch)
+        else:
+            process_time.batch(unix_time for row in batch for unix_time in row[0:5])
+            data.data.extend(map(decode_row, batch))
+        if timings.enabled:
+            decoding += time.perf_counter()-fetched
+        if progress:
+            progress(data)
+
+def departure_times(data):
+    # unix times, for splitting boards up and stitching them together. Passes go by when they pass
+    if isinstance(data, ColumnarData):
+        return [departure or passing for departure, passing in zip(data.columns["departure_scheduled"], data.columns["pass_scheduled"])]
+    return [row["departure_scheduled"]["ut"] or row["pass_scheduled"]["ut"] or 0 for row in data.data]
+
+def join_data(schema, parts):
+    # parts is [(data, positions)], those rows of each one after the other. Rows are shared, not copied, with the records backend
+    if config.get("data-backend") == "columnar":
+        joined = ColumnarData(schema)
+        for data, positions in parts:
+            if positions:
+                joined.copy_rows(data, positions)
+        return joined
+    return Data(schema, [data.data[i] for data, positions in parts for i in positions])
+
+class ColumnPlan():
+    __slots__ = ["path", "get", "name", "pad", "justify", "color"]
+
+    def __init__(self, path, get, name, pad, justify, color):
+        self.path, self.get, self.name, self.pad, self.justify, self.color = path, get, name, pad, justify, color
+
+def column_getter(levels):
+    # Schemas are never more than two deep, so avoid the generic loop for those
+    if len(levels)==1:
+        return itemgetter(levels[0])
+    elif len(levels)==2:
+        first, second = levels
+        return lambda row: row[first][second]
+    def get(row):
+        for level in levels:
+            row = row[level]
+        return row
+    return get
+
+def compile_column(schema, column):
+    # Walk the schema once, letting "_" entries at each level fill in anything the leaf leaves out
+    inherited_name, inherited_pad, inherited_justify, inherited_color = (None,)*4
+    current_schema = schema
+    levels = column.split("/")
+    for level in levels:
+        inherited_name, inherited_pad, inherited_justify, inherited_color = [a or b for a,b in zip((inherited_name, inherited_pad, inherited_justify, inherited_color), (current_schema.get("_",()) + (None,None,None,None))[:4] )]
+        current_schema = current_schema[level]
+    name, pad, justify, color_scheme = (tuple(current_schema) + (None,None,None,None))[:4]
+
+    return ColumnPlan(column, column_getter(levels),
+        name or inherited_name, pad or inherited_pad,
+        justify or inherited_justify or str.ljust, color_scheme or inherited_color or 0)
+
+# (id(schema), format) -> (schema, plans), the schema's kept so its id can't be recycled under us
+column_plan_cache = {}
+
+def compile_columns(schema, format):
+    key = (id(schema), tuple(format))
+    cached = column_plan_cache.get(key)
+    if cached and cached[0] is schema:
+        return cached[1]
+    plans = [compile_column(schema, column) for column in format]
+    column_plan_cache[key] = (schema, plans)
+    return plans
+
+LINE_LOOKAHEAD = 20
+
+# Short names for what / filters and searches on and s sorts by, and the column each means
+SEARCH_FIELDS = OrderedDict([("sig", "service/signalling_id"), ("op", "service/atoc_code"), ("pt", "platform"), ("cat", "service/category")])
+# The column's own name or path will do as well
+SEARCH_ALIASES = dict([(name, path) for name,path in SEARCH_FIELDS.items()] + [(path, path) for path in SEARCH_FIELDS.values()]
+    + [(path.split("/")[-1], path) for path in SEARCH_FIELDS.values()])
+
+def natural_key(value):
+    # Platform 9 before platform 10, and blanks last
+    return (not value, [int(part) if part.isdigit() else part for part in re.split(r"(\d+)", value)])
+
+class RowIndex():
+    # What a column shows for each row -> which rows, made the first time it's wanted after a refresh
+    def __init__(self, buffer, path):
+        get = column_getter(path.split("/"))
+        # position in data.data -> value, as it's displayed (live platform and so on), so that's what's matched
+        self.values = []
+        self.positions = {}
+        for i,row in enumerate(buffer.data.data):
+            value = get(row)
+            value = "" if value is None else buffer.substitute_fn(row, path, (str(value), 0))[0].strip().upper()
+            self.values.append(value)
+            self.positions.setdefault(value, []).append(i)
+        self.order = None
+
+    def matching(self, text):
+        # Everything starting with text, there's only ever a few hundred distinct values to look through
+        return [i for value,positions in self.positions.items() if value.startswith(text) for i in positions]
+
+    def sorted(self):
+        if self.order is None:
+            # Stable, so each value's rows stay in time order
+            self.order = sorted(range(len(self.values)), key=lambda i: natural_key(self.values[i]))
+        return self.order
+
+Snapshot = namedtuple("Snapshot", ["data", "params", "fetched"])
+
+class SnapshotCache():
+    # Recent query results, so going back to a board or service doesn't have to wait on the database
+    def __init__(self, size, ttl):
+        self.size, self.ttl = size, ttl
+        self.snapshots = OrderedDict()
+        # Prefetching fills these in from a worker
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            snapshot = self.snapshots.get(key)
+            if snapshot:
+                self.snapshots.move_to_end(key)
+            return snapshot
+
+    def put(self, key, data, params):
+        with self.lock:
+            self.snapshots[key] = Snapshot(data, params, time.time())
+            self.snapshots.move_to_end(key)
+            while len(self.snapshots) > self.size:
+                self.snapshots.popitem(last=False)
+
+    def fresh(self, snapshot, params):
+        return snapshot.params==params and time.time()-snapshot.fetched < self.ttl
+
+    def has(self, key):
+        # Fresh or not, without counting as a use
+        with self.lock:
+            return key in self.snapshots
+
+    def has_fresh(self, key, params=()):
+        snapshot = self.get(key)
+        return bool(snapshot) and self.fresh(snapshot, params)
+
+    def discard(self, key):
+        with self.lock:
+            self.snapshots.pop(key, None)
+
+snapshots = SnapshotCache(config.get("snapshot-cache-size", 16), config.get("snapshot-ttl", 30))
+# Services speculatively loaded from boards, kept apart so they can't push out anything actually looked at
+prefetched = SnapshotCache(config.get("prefetch-cache-size", 64), config.get("prefetch-ttl", 120))
+# Board windows either side of the ones being looked at, keyed by station, start and length, see BoardBuffer.page
+segments = SnapshotCache(config.get("segment-cache-size", 8), config.get("segment-ttl", 120))
+
+class SharedSnapshots():
+    # Snapshots in files that every client on the host can read, so a board watched by a dozen of them is only queried by one.
+    # Files are pickles, so the directory has to be this user's alone
+    def __init__(self, path, ttl, lock_timeout):
+        self.path, self.ttl, self.lock_timeout = path, ttl, lock_timeout
+        os.makedirs(path, mode=0o700, exist_ok=True)
+        info = os.stat(path)
+        if info.st_uid != os.getuid() or info.st_mode & 0o022:
+            raise PermissionError("{} has to belong to this user and not be writable by anyone else".format(path))
+        # key -> lock file held while this process refreshes it
+        self.held = {}
+        # When old files were last cleared out
+        self.pruned = 0
+
+    def filename(self, key, params, suffix):
+        import hashlib
+        # The window start's part of it, boards only match if they're for the same window
+        return os.path.join(self.path, hashlib.sha1(repr((key, params)).encode()).hexdigest()[:20] + suffix)
+
+    def get(self, key, params):
+        import mmap, pickle
+        try:
+            with open(self.filename(key, params, ".snap"), "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                stored, snapshot = pickle.loads(m)
+        except (OSError, ValueError, EOFError, pickle.UnpicklingError):
+            return None
+        if stored != (key, params) or time.time()-snapshot.fetched >= self.ttl:
+            return None
+        return snapshot
+
+    def put(self, key, data, params):
+        import pickle
+        path = self.filename(key, params, ".snap")
+        temporary = "{}.{}".format(path, os.getpid())
+        try:
+            with open(temporary, "wb") as f:
+                pickle.dump(((key, params), Snapshot(data, params, time.time())), f, pickle.HIGHEST_PROTOCOL)
+            # Readers only ever see a whole file
+            os.replace(temporary, path)
+        except BaseException:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+            raise
+        if time.time()-self.pruned > self.ttl:
+            self.prune()
+
+    def prune(self):
+        # Every new window start makes new files, so anything expired is removed, as are locks nobody's claimed for as long
+        import fcntl
+        self.pruned = time.time()
+        for name in os.listdir(self.path):
+            path = os.path.join(self.path, name)
+            try:
+                if time.time()-os.stat(path).st_mtime < max(self.ttl, self.lock_timeout):
+                    continue
+                if name.endswith(".lock"):
+                    with open(path, "a") as f:
+                        # Not if it's held, by a process that's stuck or otherwise. claim notices if it's removed under it
+                        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                        os.remove(path)
+                elif ".snap" in name:
+                    # Temporary ones too, from a put that never finished
+                    os.remove(path)
+            except (BlockingIOError, FileNotFoundError):
+                pass
+
+    def claim(self, key, params):
+        import fcntl
+        # True if it's this process's turn to query. A holder that's died has its lock dropped by the kernel,
+        # one that's been at it longer than lock_timeout is assumed stuck and gone round
+        path = self.filename(key, params, ".lock")
+        f = open(path, "a+")
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            f.seek(0)
+            stamp = f.read().split()
+            f.close()
+            return len(stamp) == 2 and time.time()-float(stamp[1]) > self.lock_timeout
+        # prune might have removed it before it was locked, in which case another process could be locking a new one
+        try:
+            current = os.path.samestat(os.stat(path), os.fstat(f.fileno()))
+        except FileNotFoundError:
+            current = False
+        if not current:
+            f.close()
+            return False
+        f.seek(0)
+        f.truncate()
+        f.write("{} {}".format(os.getpid(), time.time()))
+        f.flush()
+        self.held[(key, params)] = f
+        return True
+
+    def release(self, key, params):
+        f = self.held.pop((key, params), None)
+        if f:
+            f.close()
+
+shared_snapshots = None
+if config.get("shared-cache"):
+    shared_snapshots = SharedSnapshots(config["shared-cache"], config.get("snapshot-ttl", 30), config.get("shared-lock-timeout", 30))
+
+class BufferHistory():
+    def __init__(self, size):
+        self.size = size
+        self.buffers = []
+        self.position = -1
+
+    def push(self, buffer):
+        # Like a browser, going somewhere new drops anything forward of here
+        del self.buffers[self.position+1:]
+        self.buffers.append(buffer)
+        del self.buffers[:-self.size]
+        self.position = len(self.buffers)-1
+        return buffer
+
+    def back(self):
+        self.position = max(self.position-1, 0)
+        return self.buffers[self.position]
+
+    def forward(self):
+        self.position = min(self.position+1, len(self.buffers)-1)
+        return self.buffers[self.position]
+
+    def notify(self, payload):
+        # Every buffer, not just the one on screen. Polling's slow with push on, so one that's gone back to would be out of date otherwise
+        for buffer in self.buffers:
+            buffer.notify(payload)
+
+def cell_width(cell):
+    return 1 if cell[1] is None else len(cell[1])
+
+class FrameWindow():
+    # Remembers what it last drew, so only cells which have actually changed are sent to the terminal
+    def __init__(self, window):
+        self.window = window
+        self.frame = {}
+        self.dirty = False
+        self.calls = 0
+
+    def __getattr__(self, name):
+        return getattr(self.window, name)
+
+    def reset(self):
+        self.window.erase()
+        self.frame.clear()
+        self.dirty = True
+        self.calls += 1
+
+    def draw_cell(self, y, x, text, attr):
+        # A text of None is a single line-drawing character, given as the attr
+        if text is None:
+            self.window.hline(y, x, attr, 1)
+        else:
+            self.window.addstr(y, x, text, attr)
+        self.calls += 1
+
+    def draw_row(self, y, cells):
+        previous = self.frame.get(y, [])
+        if cells == previous:
+            return
+        self.frame[y] = cells
+        self.dirty = True
+        # Cells only line up with the last frame if they're all in the same place and the same width
+        if len(cells)!=len(previous) or any(a[0]!=b[0] or cell_width(a)!=cell_width(b) for a,b in zip(cells, previous)):
+            self.window.move(y, 0)
+            self.window.clrtoeol()
+            self.calls += 2
+            previous = []
+        for i,cell in enumerate(cells):
+            if i >= len(previous) or previous[i]!=cell:
+                self.draw_cell(y, *cell)
+
+    def truncate(self, lines):
+        for y in [y for y in self.frame if y >= lines]:
+            self.window.move(y, 0)
+            self.window.clrtoeol()
+            self.calls += 2
+            del self.frame[y]
+            self.dirty = True
+
+    def flush(self, force=False):
+        if self.dirty or force:
+            self.window.noutrefresh()
+            self.calls += 1
+        self.dirty = False
+
+class FormattedLines():
+    # Rows are only formatted once something asks for them, and only the most recently used are kept
+    def __init__(self, rows, format_fn, size):
+        self.rows, self.format_fn, self.size = rows, format_fn, size
+        self.cache = OrderedDict()
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        line = self.cache.get(index)
+        if line is None:
+            line = self.cache[index] = self.format_fn(self.rows[index])
+            if len(self.cache) > self.size:
+                self.cache.popitem(last=False)
+        else:
+            self.cache.move_to_end(index)
+        return line
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def prefetch(self, start, stop):
+        for i in range(max(start, 0), min(stop, len(self))):
+            self[i]
+
 class Buffer():
+    # Only query-backed buffers have anything new to fetch
+    refreshable = False
+    # Short names from SEARCH_FIELDS that make sense for these rows
+    search_fields = ()
+
     def __init__(self):
         self.data = []
         self.format = []
         self.title = ""
         self.line_offset = 0
-        self.lines = []
+        self.selected = 0
+        self.lines = FormattedLines([], None, 0)
+        self.plans = []
         self.col_names = []
         self.last_refreshed = datetime.datetime.now()
+        self.refreshing = False
+        self.refreshed = None
+        self.progress = None
+        self.refresh_failed = False
+        self.push_pending = False
+        # path -> RowIndex, thrown away on every refresh
+        self.indexes = {}
+        # path -> value, every one of which a row has to have to be shown
+        self.filters = OrderedDict()
+        self.sort = None
+        self.last_search = None
+        # Positions in data.data in the order they're shown, or None for all of them as they came
+        self.view = None
+        self.view_positions = {}
 
     def substitute_fn(self, x,y,z):
         return z
 
     def renew(self):
+        if timings.enabled:
+            start = time.perf_counter()
         self.col_names.clear()
-        self.lines.clear()
-
-        # Column headers
-        for column in self.format:
-            inherited_name, inherited_pad, inherited_justify, inherited_color = (None,)*4
-            current_schema = self.data.schema
-            for level in column.split("/"):
-                inherited_name, inherited_pad, inherited_justify, inherited_color = [a or b for a,b in zip((inherited_name, inherited_pad, inherited_justify, inherited_color), (current_schema.get("_",()) + (None,None,None, None))[:4] )]
-                current_schema = current_schema[level]
-            name, pad, color_scheme = current_schema[0], current_schema[1], 0
-
-            if len(current_schema)>=4:
-                color_scheme = current_schema[3]
-
-            name, pad, color_scheme = name or inherited_name, pad or inherited_pad, color_scheme or inherited_color or 0
-
-            self.col_names.append((name[:pad].center(pad), 0))
-
-        # Columns themselves
-        for row in self.data.data:
-            line = []
-            for display_col in self.format:
-                inherited_name, inherited_pad, inherited_justify, inherited_color = (None,)*4
-                current_cell = row
-                current_schema = self.data.schema
-                for level in display_col.split("/"):
-                    inherited_name, inherited_pad, inherited_justify, inherited_color = [a or b for a,b in zip((inherited_name, inherited_pad, inherited_justify, inherited_color), (current_schema.get("_",()) + (None,None,None,None))[:4] )]
-                    current_cell = current_cell[level]
-                    current_schema = current_schema[level]
 
-                pad, justify, color_scheme = current_schema[1], None, 0
-                if len(current_schema)>=3:
-                    justify = current_schema[2]
-                if len(current_schema)>=4:
-                    color_scheme = current_schema[3]
+        self.plans = compile_columns(self.data.schema, self.format)
 
-                pad, justify, color_scheme = pad or inherited_pad, justify or inherited_justify, color_scheme or inherited_color or 0
+        # Column headers
+        for plan in self.plans:
+            self.col_names.append((plan.name[:plan.pad].center(plan.pad), 0))
+
+        self.indexes = {}
+        self.arrange()
+        if timings.enabled:
+            timings.record("renew", time.perf_counter()-start, rows=len(self.lines))
+
+    def index(self, path):
+        if path not in self.indexes:
+            self.indexes[path] = RowIndex(self, path)
+        return self.indexes[path]
+
+    def arrange(self):
+        # Filtered and sorted from the indexes, so changing either doesn't mean looking at every row again
+        view = None
+        for path, value in self.filters.items():
+            positions = self.index(path).positions.get(value, [])
+            view = positions if view is None else sorted(set(view).intersection(positions))
+        if self.sort:
+            order = self.index(self.sort).sorted()
+            if view is not None:
+                shown = set(view)
+                order = [i for i in order if i in shown]
+            view = order
+        self.view = view
+        self.view_positions = {} if view is None else {position: i for i,position in enumerate(view)}
+
+        # Columns themselves, formatted as they're scrolled into view
+        rows = self.data.data if view is None else [self.data.data[i] for i in view]
+        self.lines = FormattedLines(rows, self.format_line, config.get("line-cache-size", 512))
+        self.selected = max(min(self.selected, len(self.lines)-1), 0)
+        self.line_offset = max(min(self.line_offset, len(self.lines)-1), 0)
+        self.invalidate()
 
-                final_row_text, final_row_color = self.substitute_fn(row, display_col, (str(current_cell), color_scheme))
+    def find(self, text, dim_lines):
+        # "/1A23" goes to the next row showing that in any search field, "/op=VT pt=4" only shows rows which match, "/" shows them all again
+        if not self.search_fields:
+            return
+        terms = text.upper().split()
+        if not terms or "=" in text:
+            self.filters.clear()
+            for term in terms:
+                name, _, value = term.partition("=")
+                path = SEARCH_ALIASES.get(name.lower())
+                if path:
+                    self.filters[path] = value
+            self.selected = self.line_offset = 0
+            self.arrange()
+        else:
+            self.last_search = " ".join(terms)
+            self.search_next(dim_lines)
+
+    def search_next(self, dim_lines):
+        if not self.last_search or not self.search_fields:
+            return
+        positions = {i for name in self.search_fields for i in self.index(SEARCH_FIELDS[name]).matching(self.last_search)}
+        if self.view is not None:
+            positions = {self.view_positions[i] for i in positions if i in self.view_positions}
+        if positions:
+            # The next one down, round to the top again after the last
+            after = [i for i in positions if i > self.selected]
+            self.move_selection(min(after or positions)-self.selected, dim_lines)
+
+    def cycle_sort(self):
+        if not self.search_fields:
+            return
+        paths = [None] + [SEARCH_FIELDS[name] for name in self.search_fields]
+        self.sort = paths[(paths.index(self.sort)+1) % len(paths)]
+        self.selected = self.line_offset = 0
+        self.arrange()
+
+    def row_time(self, row):
+        return next((row[tag]["ut"] for tag in ["departure_scheduled", "pass_scheduled", "arrival_scheduled"] if row[tag]["ut"]), None)
+
+    def time_base(self):
+        # hhmm's the first one on or after this. Just the first row's time here, a board has its window
+        return next((datetime.datetime.fromtimestamp(ut) for ut in map(self.row_time, self.lines.rows) if ut), None)
+
+    def jump_to_time(self, hhmm, dim_lines):
+        # First row at or after hhmm. Query order's by time anyway, so sorted by something else it's just the first
+        if not self.search_fields or not re.fullmatch(r"\d{4}", hhmm) or int(hhmm[:2]) > 23 or int(hhmm[2:]) > 59:
+            return
+        base = self.time_base()
+        if base is None:
+            return
+        # Past midnight if it's earlier in the day than the base, 0030 on a board from 2300 is the next day's
+        at = base.replace(hour=int(hhmm[:2]), minute=int(hhmm[2:]), second=0, microsecond=0)
+        if at < base.replace(second=0, microsecond=0):
+            at += datetime.timedelta(days=1)
+        at = at.timestamp()
+        for i,row in enumerate(self.lines.rows):
+            if (self.row_time(row) or 0) >= at:
+                self.move_selection(i-self.selected, dim_lines)
+                return
+
+    def format_line(self, row):
+        line = []
+        for plan in self.plans:
+            current_cell = plan.get(row)
+
+            final_row_text, final_row_color = self.substitute_fn(row, plan.path, (str(current_cell), plan.color))
+
+            if current_cell is None:
+                final_row_text = ""
+            line.append((plan.justify(final_row_text, plan.pad), final_row_color))
+        return line
+
+    def move_selection(self, n, dim_lines):
+        self.selected = max(min(self.selected+n, len(self.lines)-1), 0)
+        # Drag the view along with the selection
+        if self.selected < self.line_offset:
+            self.line_offset = self.selected
+        elif self.selected >= self.line_offset+dim_lines:
+            self.line_offset = self.selected-dim_lines+1
+        self.invalidate()
 
-                if current_cell==None:
-                    final_row_text = ""
-                final_row_text = (justify or str.ljust)(final_row_text, pad)
+    def selected_row(self):
+        if 0 <= self.selected < len(self.lines):
+            return self.lines.rows[self.selected]
 
-                line.append((final_row_text, final_row_color))
+    def open_selected(self):
+        return None
 
-            self.lines.append(line)
-        self.invalidate()
+    def consider_prefetch(self):
+        pass
 
-    def scroll_up(self,n):
-        self.line_offset = max(self.line_offset-n, 0)
-        self.invalidate()
-
-    def scroll_down(self,n):
-        self.line_offset = min(self.line_offset+n, len(self.lines))
-        self.invalidate()
+    def next_pane(self):
+        pass
 
     def position_summary(self,dim_lines):
-        return "[{}..{}/{}]".format(self.line_offset+1, min(self.line_offset+dim_lines, len(self.lines)), len(self.lines))
+        summary = "[{}..{}/{}]".format(self.line_offset+1, min(self.line_offset+dim_lines, len(self.lines)), len(self.lines))
+        names = {path: name for name,path in SEARCH_FIELDS.items()}
+        arranged = ["{}={}".format(names[path], value) for path,value in self.filters.items()] + (["by " + names[self.sort]] if self.sort else [])
+        return " ".join(arranged + [summary])
 
     def render(self, window, dim_lines, dim_cols):
-        for i,row in enumerate(self.lines[self.line_offset:self.line_offset+dim_lines]):
+        if not self.body_outstanding:
+            return
+        window.truncate(self.draw_lines(window, 0, dim_lines))
+        self.body_outstanding = False
+
+    def draw_lines(self, window, top, dim_lines, focused=True):
+        # Draws from line top of window down, and says how many lines that came to
+        # A little either side of the screen, so scrolling a line or two doesn't have to wait on formatting
+        self.lines.prefetch(self.line_offset-LINE_LOOKAHEAD, self.line_offset+dim_lines+LINE_LOOKAHEAD)
+        rows = self.lines[self.line_offset:self.line_offset+max(dim_lines, 0)]
+        for i,row in enumerate(rows):
+            cells = []
             next_col_x = 0
+            highlight = curses.A_REVERSE if focused and self.line_offset+i==self.selected else 0
             for column,attr in row:
                 # Intersperse odd columns with dots to make it easier to read across
                 if next_col_x and i%2:
-                    window.hline(i, next_col_x-1, curses.ACS_BULLET, 1)
-                window.addstr(i, next_col_x, column, curses.color_pair(attr))
+                    cells.append((next_col_x-1, None, curses.ACS_BULLET))
+                cells.append((next_col_x, column, curses.color_pair(attr) | highlight))
                 next_col_x += len(column) + 1
-        if self.body_outstanding:
-            window.refresh()
-        self.body_outstanding = False
+            window.draw_row(top+i, cells)
+        return len(rows)
 
     def render_headers(self, dim_lines, dim_cols, title_window, cols_window):
-        title_window.addstr(0, 0, self.title, curses.A_BOLD)
+        if not self.headers_outstanding:
+            return
         current_view_str = self.position_summary(dim_lines)
-        title_window.addstr(0, dim_cols-len(current_view_str)-1, current_view_str, curses.A_BOLD)
+        if self.refreshing:
+            current_view_str = "REFRESHING… " + current_view_str
+        elif self.refresh_failed:
+            current_view_str = "REFRESH FAILED " + current_view_str
+        title_window.draw_row(0, [(0, self.title, curses.A_BOLD), (dim_cols-len(current_view_str)-1, current_view_str, curses.A_BOLD)])
 
+        cells = []
         next_col_x = 0
         for column,attr in self.col_names:
             if next_col_x:
-                cols_window.hline(0, next_col_x-1, curses.ACS_VLINE, 1)
+                cells.append((next_col_x-1, None, curses.ACS_VLINE))
 
-            cols_window.addstr(0, next_col_x, column, curses.color_pair(attr))
+            cells.append((next_col_x, column, curses.color_pair(attr)))
             next_col_x += len(column) + 1
-
-        if self.headers_outstanding:
-            title_window.refresh()
-            cols_window.refresh()
+        cols_window.draw_row(0, cells)
         self.headers_outstanding = False
 
     def invalidate(self):
         self.headers_outstanding, self.body_outstanding = True, True
 
+    def fetch(self):
+        return self.data
+
+    def apply(self, data):
+        self.data = data
+        self.renew()
+
     def refresh(self):
+        self.apply(self.fetch())
+
+    def start_refresh(self):
+        # The previous snapshot stays up until collect_refresh swaps the new one in on the UI thread
+        if self.refreshing:
+            return
+        self.refreshing = True
         self.invalidate()
+        threading.Thread(target=self.refresh_worker, daemon=True).start()
+
+    def refresh_worker(self):
+        try:
+            self.refreshed = (self.fetch_shared() if shared_snapshots and self.cache_key() else self.fetch(), None)
+        except Exception as e:
+            self.refreshed = (None, e)
+        self.refreshing = False
+
+    def post_progress(self, data):
+        self.progress = data
+
+    def fetch_full(self):
+        # Everything, rather than just what's changed since this buffer last fetched
+        return self.fetch()
+
+    def fetch_shared(self):
+        # Another client might have just done this query, or be in the middle of it
+        key, params = self.cache_key(), self.query_params()
+        while True:
+            snapshot = shared_snapshots.get(key, params)
+            if snapshot:
+                return snapshot.data
+            if shared_snapshots.claim(key, params):
+                break
+            time.sleep(0.2)
+        try:
+            # What's shared has to be the whole thing, not a delta against this client's copy
+            data = self.fetch_full()
+            shared_snapshots.put(key, data, params)
+            return data
+        finally:
+            shared_snapshots.release(key, params)
+
+    def collect_refresh(self):
+        # Nothing to show yet, so show rows as they come in rather than waiting for the lot
+        progress, self.progress = self.progress, None
+        if progress is not None:
+            if not self.data.data:
+                self.apply(progress)
+            if progress is self.data:
+                self.invalidate()
+
+        if self.refreshed:
+            (data, error), self.refreshed = self.refreshed, None
+            self.refresh_failed = error is not None
+            if data:
+                self.apply(data)
+                if self.cache_key():
+                    snapshots.put(self.cache_key(), self.data, self.query_params())
+            self.invalidate()
+
+    def cache_key(self):
+        return None
+
+    def query_params(self):
+        return ()
+
+    def queries_issued(self):
+        # (statement, args) for what a refresh of this buffer would run, for plans.py
+        return []
+
+    def load(self, empty):
+        # Show whatever's cached for this query straight away, and only go to the database if it's out of date
+        cache = snapshots if snapshots.get(self.cache_key()) else prefetched
+        snapshot = cache.get(self.cache_key())
+        if not snapshot and shared_snapshots and self.cache_key():
+            snapshot = shared_snapshots.get(self.cache_key(), self.query_params())
+            if snapshot:
+                snapshots.put(self.cache_key(), snapshot.data, snapshot.params)
+                cache = snapshots
+        self.apply(snapshot.data if snapshot else empty)
+        if snapshot and cache.fresh(snapshot, self.query_params()):
+            self.last_refreshed = datetime.datetime.fromtimestamp(snapshot.fetched)
+        else:
+            self.start_refresh()
+
+    def affected_by(self, payload):
+        return False
+
+    def notify(self, payload):
+        # None means notifications might have been missed
+        if payload is None or self.affected_by(payload):
+            self.push_pending = True
 
     def consider_refresh(self):
-        if (datetime.datetime.now()-self.last_refreshed).seconds > 30:
+        self.collect_refresh()
+        if not self.refreshable or self.refreshing:
+            return
+        since_refresh = (datetime.datetime.now()-self.last_refreshed).seconds
+        # With push updates, polling's only a fallback. Notifications come in bursts, so hold off briefly after the last refresh
+        if since_refresh > (300 if config.get("push-refresh") else 30) or (self.push_pending and since_refresh >= 2):
+            self.push_pending = False
             self.last_refreshed = datetime.datetime.now()
-            self.refresh()
+            self.start_refresh()
 
 class TextBuffer(Buffer):
     def __init__(self, title, data, format):
@@ -165,7 +1198,40 @@ class TextBuffer(Buffer):
         self.title = title
         self.renew()
 
+class ExplainBuffer(Buffer):
+    # Query plans for everything another buffer's refreshes do, see plans.py. They're run for real, so it's fetched like a refresh
+    def __init__(self, buffer, width):
+        super(ExplainBuffer, self).__init__()
+        self.buffer, self.width = buffer, width
+        self.format = ["line"]
+        self.title = "QUERY PLANS - " + buffer.title
+        self.load(self.lines_data([]))
+
+    def lines_data(self, lines):
+        # A CREATE INDEX can be wider than the screen, and curses would wrap it onto the next line
+        return Data({"line": ("plan", self.width)}, [{"line": line[:self.width]} for line in lines])
+
+    def fetch(self):
+        import plans
+        try:
+            lines = plans.report(plans.explain_buffer(self.buffer), plans.plan_log)
+        except Exception as e:
+            lines = ["EXPLAIN failed: {}".format(e)]
+        return self.lines_data(lines)
+
+# Live data for rows already on a board, see BoardBuffer.get_delta
+BoardDelta = namedtuple("BoardDelta", ["movements", "schedules"])
+
 class BoardBuffer(Buffer):
+    refreshable = True
+    search_fields = tuple(SEARCH_FIELDS)
+    # Whether scrolling off either end moves the board's window, see page
+    pageable = True
+    # Every so often do the whole query anyway, to pick up new and changed schedules
+    FULL_REFRESH_INTERVAL = 10
+    # Movements can be reported a little while after they happen
+    DELTA_SLACK = 15*60
+
     def __init__(self, dt_start, duration, location_code):
         super(BoardBuffer, self).__init__()
         self.dt_start, self.duration, self.location_code = dt_start, duration, location_code
@@ -174,13 +1240,267 @@ class BoardBuffer(Buffer):
             "arrival_scheduled/short", "departure_scheduled/short", "pass_scheduled/short", "platform", "service/current_variation",
             "arrival_actual/short", "departure_actual/short", "origin/name", "destination/name"
             ]
-        self.refresh()
+        self.watermark = 0
+        # A cached snapshot might be for a different window, so the first refresh is always a full one
+        self.polls_since_full = self.FULL_REFRESH_INTERVAL
+        self.iids, self.stanoxes = set(), set()
+        self.prefetching = False
+        # (uid, date) of the row selected when services were last prefetched
+        self.prefetched_around = None
+        # The board's made of duration minute segments counted from dt_start, first to last of them inclusive
+        self.first = self.last = 0
+        # (segment, n, dim_lines) for a move off the end that's waiting on the segment's query
+        self.pending = None
+        # Segments being queried for, and ones this board's put in segments
+        self.segment_fetches, self.cached_segments = set(), set()
+        self.retitle()
+        self.load(Data(BOARD_SCHEMA, []))
+
+    def retitle(self):
+        self.title = "STATION DEPARTURE BOARD ENQUIRY - {} {:%Y-%m-%d %H:%M:%S} - {} MINUTES".format(self.location_code, self.window_start(), self.duration*(self.last-self.first+1))
+
+    def segment_start(self, k):
+        return int(self.dt_start.timestamp()) + k*self.duration*60
+
+    def window_start(self):
+        return datetime.datetime.fromtimestamp(self.segment_start(self.first))
+
+    def time_base(self):
+        return self.window_start()
+
+    def segment_key(self, k):
+        return ("segment", self.location_code, self.segment_start(k), self.duration)
+
+    def cache_key(self):
+        # The window start moves on every time trjd's used, so it's not part of the key
+        return ("board", self.location_code, self.duration)
+
+    def open_selected(self):
+        row = self.selected_row()
+        if row:
+            return ServiceBuffer(row["service"]["date"], row["service"]["uid"])
+
+    def move_selection(self, n, dim_lines):
+        # Going off either end pages the board back or on in time, unless it's sorted by something other than time
+        if n and self.pageable and self.sort is None and self.pending is None:
+            if (n > 0 and self.selected >= len(self.lines)-1) or (n < 0 and self.selected <= 0):
+                self.page(self.last+1 if n > 0 else self.first-1, n, dim_lines)
+                return
+        super(BoardBuffer, self).move_selection(n, dim_lines)
+
+    def page(self, k, n, dim_lines):
+        self.pending = (k, n, dim_lines)
+        self.request_segment(k)
+        # Usually it's been prefetched, so there's no waiting
+        self.collect_segment()
+        self.invalidate()
 
-    def refresh(self):
-        self.title = "STATION DEPARTURE BOARD ENQUIRY - {} {:%Y-%m-%d %H:%M:%S} - {} MINUTES".format(self.location_code, self.dt_start, self.duration)
-        self.data = self.get_board(self.dt_start, self.duration, self.location_code)
+    def request_segment(self, k, expired=True):
+        # expired is whether one that's cached but out of date is fetched again
+        key = self.segment_key(k)
+        if k in self.segment_fetches or segments.has_fresh(key) or (not expired and segments.has(key)):
+            return
+        self.segment_fetches.add(k)
+        self.cached_segments.add(k)
+        threading.Thread(target=self.segment_worker, args=(k,), daemon=True).start()
+
+    def segment_worker(self, k):
+        try:
+            start = datetime.datetime.fromtimestamp(self.segment_start(k))
+            segments.put(self.segment_key(k), self.get_board(start, self.duration, self.location_code), ())
+        except Exception:
+            # collect_segment notices if it was wanted
+            pass
+        finally:
+            self.segment_fetches.discard(k)
+
+    def prefetch_segments(self, expired=False):
+        # Either side of what's on the board, so paging doesn't have to wait. Ones that have only expired are left
+        # until the board's paged, or a board that never is would query for them every segment-ttl
+        if self.pageable and self.sort is None:
+            self.request_segment(self.last+1, expired)
+            self.request_segment(self.first-1, expired)
+
+    def collect_segment(self):
+        # A refresh in flight is for the board as it was, so that has to be in before anything's stitched on to it
+        if not self.pending or self.refreshing or self.refreshed:
+            return
+        k, n, dim_lines = self.pending
+        # In this order, the worker puts the segment before it says it's finished
+        fetching = k in self.segment_fetches
+        snapshot = segments.get(self.segment_key(k))
+        if snapshot and segments.fresh(snapshot, ()):
+            self.pending = None
+            self.stitch(k, snapshot.data)
+            # Finish the move that went off the end, without going on to page again if the segment's empty
+            super(BoardBuffer, self).move_selection(n, dim_lines)
+            self.prefetch_segments(True)
+        elif not fetching:
+            # The query failed, paging again will have another go
+            self.pending = None
+            self.refresh_failed = True
+            self.invalidate()
+
+    def stitch(self, k, data):
+        # Segment k goes on whichever end it's next to. Windows include both their ends, so rows on the boundary are only taken once
+        mine, theirs = departure_times(self.data), departure_times(data)
+        kept = range(len(mine))
+        if k > self.last:
+            boundary, self.last = self.segment_start(k), k
+            added = [i for i,t in enumerate(theirs) if t > boundary]
+        else:
+            boundary, self.first = self.segment_start(self.first), k
+            added = [i for i,t in enumerate(theirs) if t < boundary]
+        # Too many and the far end goes back in the cache, from where it can come straight back
+        if self.last-self.first+1 > config.get("board-segments", 3):
+            if k == self.last:
+                dropped, edge = self.first, self.segment_start(self.first+1)
+                self.first += 1
+                kept, gone = [i for i,t in enumerate(mine) if t >= edge], [i for i,t in enumerate(mine) if t <= edge]
+            else:
+                dropped, edge = self.last, self.segment_start(self.last)
+                self.last -= 1
+                kept, gone = [i for i,t in enumerate(mine) if t <= edge], [i for i,t in enumerate(mine) if t >= edge]
+            segments.put(self.segment_key(dropped), join_data(BOARD_SCHEMA, [(self.data, gone)]), ())
+            self.cached_segments.add(dropped)
+
+        # The selected row stays selected, where it was on the screen
+        key = lambda row: (row["service"]["iid"], row["departure_scheduled"]["ut"])
+        row = self.selected_row()
+        selected, offset = row and key(row), self.selected-self.line_offset
+        self.apply(join_data(BOARD_SCHEMA, [(self.data, kept), (data, added)] if k == self.last else [(data, added), (self.data, kept)]))
+        self.retitle()
+        if selected:
+            for i,row in enumerate(self.lines.rows):
+                if key(row) == selected:
+                    self.selected, self.line_offset = i, max(i-offset, 0)
+                    break
+        self.evict_segments()
+
+    def evict_segments(self):
+        # Segments that have been scrolled well away from are let go of, rather than waiting to be pushed out
+        radius = config.get("segment-radius", 2)
+        for k in [k for k in self.cached_segments if not self.first-radius <= k <= self.last+radius]:
+            segments.discard(self.segment_key(k))
+            self.cached_segments.discard(k)
+
+    def consider_refresh(self):
+        self.collect_refresh()
+        self.collect_segment()
+        # The refresh wouldn't include a segment that's on its way
+        if self.pending is None:
+            super(BoardBuffer, self).consider_refresh()
+
+    def position_summary(self, dim_lines):
+        summary = super(BoardBuffer, self).position_summary(dim_lines)
+        if self.pending:
+            return "{}… {}".format("EARLIER" if self.pending[0] < self.first else "LATER", summary)
+        return summary
+
+    def consider_prefetch(self):
+        self.prefetch_segments()
+        # Load the services either side of the selection while nothing else is going on, so opening one is instant
+        if self.prefetching:
+            return
+        radius = config.get("prefetch-radius", 5)
+        rows = self.lines.rows[max(self.selected-radius, 0):self.selected+radius+1]
+        services = list(OrderedDict.fromkeys((row["service"]["uid"], row["service"]["date"]) for row in rows))
+        row = self.selected_row()
+        around = row and (row["service"]["uid"], row["service"]["date"])
+        # Ones that have only expired wait for the selection to move, or a board left alone would query for them every prefetch-ttl
+        moved, self.prefetched_around = around != self.prefetched_around, around
+        def wanted(service):
+            key = ("service",) + service
+            if snapshots.has_fresh(key) or prefetched.has_fresh(key):
+                return False
+            return moved or not (snapshots.has(key) or prefetched.has(key))
+        services = [service for service in services if wanted(service)]
+        if services:
+            self.prefetching = True
+            threading.Thread(target=self.prefetch_worker, args=(services,), daemon=True).start()
+
+    def prefetch_worker(self, services):
+        try:
+            for (uid, start_date), data in get_services(services).items():
+                prefetched.put(("service", uid, start_date), data, ())
+        except Exception:
+            # Nothing lost, opening the service will just query for it
+            pass
+        finally:
+            self.prefetching = False
+
+    def query_params(self):
+        return (self.dt_start, self.first, self.last)
+
+    def fetch_full(self):
+        self.polls_since_full = self.FULL_REFRESH_INTERVAL
+        return self.fetch()
+
+    def fetch(self):
+        # Schedules hardly change, so most polls only need to pick up live data for the rows already here
+        if config.get("delta-refresh", True) and self.data.data and self.polls_since_full < self.FULL_REFRESH_INTERVAL:
+            self.polls_since_full += 1
+            return self.get_delta(self.data.data, self.watermark)
+        self.polls_since_full = 0
+        # Every segment that's on the board, in one go
+        return self.get_board(self.window_start(), self.duration*(self.last-self.first+1), self.location_code, self.post_progress)
+
+    def apply(self, data):
+        if isinstance(data, BoardDelta):
+            self.apply_delta(data)
+        else:
+            self.data = data
+            self.watermark = max([row[tag]["ut"] or 0 for row in data.data for tag in ["arrival_actual", "departure_actual"]], default=0)
+            self.iids = {row["service"]["iid"] for row in data.data}
+            self.stanoxes = {row["here"]["stanox"] for row in data.data}
         self.renew()
 
+    def affected_by(self, payload):
+        return payload.get("flat_schedule_iid") in self.iids or payload.get("stanox") in self.stanoxes
+
+    def apply_delta(self, delta):
+        by_schedule, by_movement = {}, {}
+        for row in self.data.data:
+            iid = row["service"]["iid"]
+            by_schedule.setdefault(iid, []).append(row)
+            by_movement.setdefault((iid, "A", row["arrival_scheduled"]["ut"]), []).append(row)
+            # Same as the board query, passes report as departures
+            for tag in ["departure_scheduled", "pass_scheduled"]:
+                if row[tag]["ut"]:
+                    by_movement.setdefault((iid, "D", row[tag]["ut"]), []).append(row)
+
+        for iid, movement_type, datetime_scheduled, datetime_actual, *fields in delta.movements:
+            prefix = "arrival" if movement_type=="A" else "departure"
+            for row in by_movement.get((iid, movement_type, datetime_scheduled), []):
+                row["trust_" + prefix] = Movement(*fields)
+                row[prefix + "_actual"] = process_time(datetime_actual)
+            self.watermark = max(self.watermark, datetime_actual or 0)
+
+        for iid, actual_signalling_id, current_variation in delta.schedules:
+            for row in by_schedule.get(iid, []):
+                row["service"]["actual_signalling_id"] = actual_signalling_id
+                row["service"]["current_variation"] = current_variation
+
+    def delta_queries(self, rows, watermark):
+        iids = list({row["service"]["iid"] for row in rows})
+        return [(queries.MOVEMENTS_SINCE, [iids, watermark-self.DELTA_SLACK]), (queries.SCHEDULE_LIVE, [iids])]
+
+    def get_delta(self, rows, watermark):
+        def query(c):
+            results = []
+            for statement, args in self.delta_queries(rows, watermark):
+                queries.execute(c, statement, args)
+                results.append(c.fetchall())
+            return BoardDelta(*results)
+        return queries.get_pool().run(query)
+
+    def queries_issued(self):
+        # A full refresh, then what the polls in between do
+        issued = [(queries.BOARD, self.board_args(self.window_start(), self.duration*(self.last-self.first+1), self.location_code))]
+        if self.data.data:
+            issued += self.delta_queries(self.data.data, self.watermark)
+        return issued
+
     def substitute_fn(self, x,y,z):
         # De-emphasise station matching query
         if y.startswith("origin") and x["here"]["tiploc"]==x["origin"]["tiploc"]:
@@ -207,125 +1527,152 @@ class BoardBuffer(Buffer):
             return (z[0], 7)
         return z
 
-    def get_board(self, starting_datetime, duration, location):
-        ret = []
-
-        time_schema_short = {
-            "iso":    (None, 19),
-            "short":  (None, 4),
-        }
-        time_schema = {
-            "iso":    (None, 19),
-            "short":  (None, 5),
-        }
-
-        location_schema = {
-            "name":   (None, 30),
-            "tiploc": (None, 7),
-            "crs":    (None, 3),
-        }
-
-        schema = {
-            "service": {
-                "uid":                  ("UID", 6, str.rjust),
-                "atoc_code":            ("o.", 2),
-                "power_type":           ("pw.", 3),
-                "category":             ("c.", 2),
-                "signalling_id":        ("sig.", 4),
-                "actual_signalling_id": ("rt.s", 4, None, 3),
-                "current_variation":    ("v.", 3, str.rjust, 3),
-                "operating_characteristics": ("oc.", 4),
-            },
-            "trust_arrival": {
-                "platform": ("pt.", 3, platform_justify),
-            },
-
-            "trust_departure": {
-                "platform": ("pt.", 3, platform_justify),
-            },
-
-            "platform": ("pt.", 3, platform_justify),
-
-            "arrival_scheduled":   {"_": ("arrival",),   **time_schema},
-            "departure_scheduled": {"_": ("departure",), **time_schema},
-            "pass_scheduled":      {"_": ("pass",),      **time_schema},
-
-            "arrival_actual":   {"_": ("arrival",  None, None, 3), **time_schema_short},
-            "departure_actual": {"_": ("departure",None, None, 3), **time_schema_short},
-
-            "origin":      {"_": ("origin",),      **location_schema},
-            "destination": {"_": ("destination",), **location_schema},
-        }
-
+    def board_args(self, starting_datetime, duration, location):
         timestamp = int(starting_datetime.timestamp())
-        with database.DatabaseConnection() as db_connection, db_connection.new_cursor() as c:
-            c.execute("""SELECT
-                arrival_scheduled,departure_scheduled,pass_scheduled,
-                ta.datetime_actual,td.datetime_actual,
-                arrival_public, departure_public,
-                platform, line, path, activity, engineering_allowance, pathing_allowance, performance_allowance,
-                ta.actual_platform, ta.actual_line, ta.actual_route, ta.actual_variation_status, ta.actual_variation, ta.actual_direction, ta.actual_source,
-                td.actual_platform, td.actual_line, td.actual_route, td.actual_variation_status, td.actual_variation, td.actual_direction, td.actual_source,
-
-                flat_schedules.uid, category, signalling_id, headcode, power_type, timing_load, speed, operating_characteristics, seating_class, sleepers,
-                reservations, catering, branding, uic_code, atoc_code,
-
-                start_date, actual_signalling_id, trust_id, current_variation,
-
-                l0.tiploc, l0.name, l0.stanox, l0.crs,
-                l1.tiploc, l1.name, l1.stanox, l1.crs,
-                l2.tiploc, l2.name, l2.stanox, l2.crs,
-                l3.tiploc, l3.name, l3.stanox, l3.crs,
-                l4.tiploc, l4.name, l4.stanox, l4.crs
-
-                FROM flat_timing
-                INNER JOIN schedule_locations ON schedule_location_iid=schedule_locations.iid
-                INNER JOIN schedules ON schedule_locations.schedule_iid=schedules.iid
-                INNER JOIN flat_schedules ON flat_timing.flat_schedule_iid=flat_schedules.iid
-
-                INNER JOIN locations as l0 ON schedule_locations.location_iid=l0.iid
-                INNER JOIN locations as l1 ON schedules.origin_location_iid=l1.iid
-                INNER JOIN locations as l2 ON schedules.destination_location_iid=l2.iid
-                LEFT JOIN locations as l3 ON flat_schedules.current_location=l3.iid
-                LEFT JOIN locations as l4 ON flat_schedules.cancellation_location=l4.iid
-
-                LEFT JOIN trust_movements as ta ON
-                (ta.movement_type='A' AND flat_schedules.iid=ta.flat_schedule_iid AND arrival_scheduled=ta.datetime_scheduled)
-                LEFT JOIN trust_movements as td ON
-                (td.movement_type='D' AND flat_schedules.iid=td.flat_schedule_iid AND (departure_scheduled=td.datetime_scheduled OR pass_scheduled=td.datetime_scheduled))
-                WHERE flat_timing.location_iid=(select iid from locations where crs=%s)
-                AND departure_scheduled BETWEEN %s AND %s ORDER BY departure_scheduled;
-                """, [location, timestamp, timestamp+60*duration])
+        return [queries.location_iid(location), timestamp, timestamp+60*duration]
 
-            for row in c:
-                row = list(row)
-                out = OrderedDict()
-                for tag in ["arrival_scheduled", "departure_scheduled", "pass_scheduled", "arrival_actual", "departure_actual"]:
-                    out[tag] = process_time(row.pop(0))
+    def get_board(self, starting_datetime, duration, location, progress=None):
+        return queries.run(queries.BOARD, self.board_args(starting_datetime, duration, location),
+            lambda c: decode_rows(BOARD_SCHEMA, c, progress))
+
+class BoardPane(BoardBuffer):
+    # One station of a SplitBoardBuffer, which does all the querying for it
+    refreshable = False
+    pageable = False
+
+    def load(self, empty):
+        self.apply(empty)
 
-                for tag in ["arrival_public", "departure_public", "platform", "line", "path", "activity", "engineering_allowance", "pathing_allowance", "performance_allowance"]:
-                    out[tag] = row.pop(0)
+class SplitBoardBuffer(BoardBuffer):
+    # Several boards on the one screen, all from one query and one refresh cycle
+    pageable = False
+    def __init__(self, dt_start, duration, location_codes):
+        super(BoardBuffer, self).__init__()
+        self.dt_start, self.duration, self.location_codes = dt_start, duration, location_codes
+        self.panes = [BoardPane(dt_start, duration, location_code) for location_code in location_codes]
+        self.focus = 0
+        self.title = "STATION DEPARTURE BOARD ENQUIRY - {} {:%Y-%m-%d %H:%M:%S} - {} MINUTES".format(" ".join(self.location_codes), self.dt_start, self.duration)
+        self.watermark = 0
+        self.polls_since_full = self.FULL_REFRESH_INTERVAL
+        self.iids, self.stanoxes = set(), set()
+        self.first = self.last = 0
+        self.pending = None
+        # data.data is each pane's Data, in order
+        self.load(Data(BOARD_SCHEMA, [pane.data for pane in self.panes]))
+
+    def cache_key(self):
+        return ("boards", tuple(self.location_codes), self.duration)
+
+    def pane_heights(self, dim_lines):
+        # Shared out as evenly as possible, each gets a line for its own title
+        share, spare = divmod(dim_lines, len(self.panes))
+        return [share + (i < spare) for i in range(len(self.panes))]
+
+    def next_pane(self):
+        self.focus = (self.focus+1) % len(self.panes)
+        self.invalidate()
+
+    def move_selection(self, n, dim_lines):
+        self.panes[self.focus].move_selection(n, self.pane_heights(dim_lines)[self.focus]-1)
+        self.invalidate()
+
+    def selected_row(self):
+        return self.panes[self.focus].selected_row()
+
+    # Searching, filtering and sorting are all for whichever pane has the focus
+    def find(self, text, dim_lines):
+        self.panes[self.focus].find(text, self.pane_heights(dim_lines)[self.focus]-1)
+        self.invalidate()
+
+    def search_next(self, dim_lines):
+        self.panes[self.focus].search_next(self.pane_heights(dim_lines)[self.focus]-1)
+        self.invalidate()
 
-                out["trust_arrival"] = OrderedDict([(tag,row.pop(0)) for tag in ["platform", "line", "route", "variation_status", "variation", "direction", "source"]])
-                out["trust_departure"] = OrderedDict([(tag,row.pop(0)) for tag in ["platform", "line", "route", "variation_status", "variation", "direction", "source"]])
+    def cycle_sort(self):
+        self.panes[self.focus].cycle_sort()
+        self.invalidate()
 
-                out["service"], out["here"], out["origin"], out["destination"], out["last_location"], out["cancellation_location"] = OrderedDict(), OrderedDict(), OrderedDict(), OrderedDict(), OrderedDict(), OrderedDict()
+    def jump_to_time(self, hhmm, dim_lines):
+        self.panes[self.focus].jump_to_time(hhmm, self.pane_heights(dim_lines)[self.focus]-1)
+        self.invalidate()
 
-                for tag in ["uid", "category", "signalling_id", "headcode", "power_type", "timing_load", "speed", "operating_characteristics", "seating_class", "sleepers", "reservations", "catering", "branding", "uic_code", "atoc_code", "date", "actual_signalling_id", "trust_id", "current_variation"]:
-                    out["service"][tag] = row.pop(0)
+    def consider_prefetch(self):
+        self.panes[self.focus].consider_prefetch()
 
-                out["service"]["operating_characteristics"] = out["service"]["operating_characteristics"].rstrip()
-                if out["platform"]:
-                    out["platform"] = out["platform"].rstrip()
+    def position_summary(self, dim_lines):
+        pane = self.panes[self.focus]
+        return "{} {}".format(pane.location_code, pane.position_summary(self.pane_heights(dim_lines)[self.focus]-1))
 
-                for first in ["here", "origin", "destination", "last_location", "cancellation_location"]:
-                    for second in ["tiploc", "name", "stanox", "crs"]:
-                        out[first][second] = row.pop(0)
+    def renew(self):
+        # Every pane has the same columns
+        self.col_names = self.panes[0].col_names
+        self.invalidate()
 
-                ret.append(out)
-            return Data(schema, ret)
+    def render(self, window, dim_lines, dim_cols):
+        if not self.body_outstanding:
+            return
+        top = 0
+        for i,(pane,height) in enumerate(zip(self.panes, self.pane_heights(dim_lines))):
+            if not height:
+                continue
+            summary = pane.position_summary(height-1)
+            attr = curses.color_pair(1 if i==self.focus else 2) | curses.A_BOLD
+            window.draw_row(top, [(0, pane.location_code.ljust(dim_cols-len(summary)-1) + summary, attr)])
+            drawn = pane.draw_lines(window, top+1, height-1, i==self.focus)
+            # Blank out whatever's left of the pane's share
+            for y in range(top+1+drawn, top+height):
+                window.draw_row(y, [])
+            top += height
+        window.truncate(top)
+        self.body_outstanding = False
+
+    def fetch(self):
+        if config.get("delta-refresh", True) and self.polls_since_full < self.FULL_REFRESH_INTERVAL:
+            self.polls_since_full += 1
+            return self.get_delta([row for pane in self.panes for row in pane.data.data], self.watermark)
+        self.polls_since_full = 0
+        return self.get_boards(self.dt_start, self.duration, self.location_codes)
+
+    def apply(self, data):
+        if isinstance(data, BoardDelta):
+            # Rows that aren't on a pane are just not found there
+            for pane in self.panes:
+                pane.apply(data)
+        else:
+            self.data = data
+            for pane, pane_data in zip(self.panes, data.data):
+                pane.apply(pane_data)
+        # The oldest, so the next delta doesn't miss anything for any of them
+        self.watermark = min(pane.watermark for pane in self.panes)
+        self.iids = set().union(*[pane.iids for pane in self.panes])
+        self.stanoxes = set().union(*[pane.stanoxes for pane in self.panes])
+        self.renew()
+
+    def queries_issued(self):
+        issued = [(queries.BOARDS, self.boards_args(self.dt_start, self.duration, self.location_codes))]
+        rows = [row for pane in self.panes for row in pane.data.data]
+        if rows:
+            issued += self.delta_queries(rows, self.watermark)
+        return issued
+
+    def boards_args(self, starting_datetime, duration, locations):
+        timestamp = int(starting_datetime.timestamp())
+        return [[queries.location_iid(location) for location in locations], timestamp, timestamp+60*duration]
+
+    def get_boards(self, starting_datetime, duration, locations):
+        args = self.boards_args(starting_datetime, duration, locations)
+        iids = args[0]
+        def consume(c):
+            grouped = OrderedDict((iid, []) for iid in iids)
+            for row in c:
+                grouped.setdefault(here_iid(row), []).append(row)
+            return Data(BOARD_SCHEMA, [decode_rows(BOARD_SCHEMA, grouped[iid]) for iid in iids])
+        return queries.run(queries.BOARDS, args, consume)
 
 class ServiceBuffer(Buffer):
+    refreshable = True
+    search_fields = tuple(SEARCH_FIELDS)
+
     def __init__(self, date_start, service_code):
         super(ServiceBuffer, self).__init__()
         self.date_start, self.service_code = date_start, service_code
@@ -333,13 +1680,24 @@ class ServiceBuffer(Buffer):
             "pass_scheduled/short", "service/current_variation", "arrival_actual/short", "trust_arrival/source",
             "departure_actual/short", "trust_departure/source", "platform", "here/tiploc", "here/name"
             ]
-        self.refresh()
-
-    def refresh(self):
         self.title = "SERVICE ENQUIRY - {} on {:%Y-%m-%d}".format(self.service_code, self.date_start)
-        self.data = self.get_board(self.date_start, self.service_code)
+        self.iids = set()
+        self.load(Data(SERVICE_SCHEMA, []))
+
+    def cache_key(self):
+        return ("service", self.service_code, self.date_start)
+
+    def fetch(self):
+        return self.get_board(self.date_start, self.service_code)
+
+    def apply(self, data):
+        self.data = data
+        self.iids = {row["service"]["iid"] for row in data.data}
         self.renew()
 
+    def affected_by(self, payload):
+        return payload.get("flat_schedule_iid") in self.iids
+
     def substitute_fn(self, x,y,z):
         # Only display general estimate if the train hasn't yet been, and nothing if it's off route
         if y=="service/current_variation" and (x["arrival_actual"]["ut"] or x["departure_actual"]["ut"]):
@@ -358,127 +1716,49 @@ class ServiceBuffer(Buffer):
             return ((x["trust_departure"]["platform"] or x["trust_arrival"]["platform"], 3))
         return z
 
-    def get_board(self, start_date, service_code):
-        ret = []
-
-        time_schema_short = {
-            "iso":    (None, 19),
-            "short":  (None, 4),
-        }
-        time_schema = {
-            "iso":    (None, 19),
-            "short":  (None, 5),
-        }
-
-        location_schema = {
-            "name":   (None, 30),
-            "tiploc": (None, 7),
-            "crs":    (None, 3),
-        }
-
-        schema = {
-            "service": {
-                "uid":                  ("UID", 6, str.rjust),
-                "atoc_code":            ("o.", 2),
-                "power_type":           ("pw.", 3),
-                "category":             ("c.", 2),
-                "signalling_id":        ("sig.", 4),
-                "actual_signalling_id": ("rt.s", 4, None, 3),
-                "current_variation":    ("v.", 3, str.rjust, 3),
-                "operating_characteristics": ("oc.", 4),
-            },
-            "trust_arrival": {
-                "platform": ("pt.", 3, platform_justify),
-                "source": ("source", 1),
-            },
-
-            "trust_departure": {
-                "platform": ("pt.", 3, platform_justify),
-                "source": ("source", 1, None, 3),
-            },
-
-            "platform": ("pt.", 3, platform_justify),
-            "activity": ("activity", 12),
-
-            "arrival_scheduled":   {"_": ("arrival",),   **time_schema},
-            "departure_scheduled": {"_": ("departure",), **time_schema},
-            "pass_scheduled":      {"_": ("pass",),      **time_schema},
-
-            "arrival_actual":   {"_": ("arrival",  None, None, 3), **time_schema_short},
-            "departure_actual": {"_": ("departure",None, None, 3), **time_schema_short},
-
-            "here":      {"_": ("location",),      **location_schema},
-            "origin":      {"_": ("origin",),      **location_schema},
-            "destination": {"_": ("destination",), **location_schema},
-        }
-
-        with database.DatabaseConnection() as db_connection, db_connection.new_cursor() as c:
-            c.execute("""SELECT
-                arrival_scheduled,departure_scheduled,pass_scheduled,
-                ta.datetime_actual,td.datetime_actual,
-                arrival_public, departure_public,
-                platform, line, path, activity, engineering_allowance, pathing_allowance, performance_allowance,
-                ta.actual_platform, ta.actual_line, ta.actual_route, ta.actual_variation_status, ta.actual_variation, ta.actual_direction, ta.actual_source,
-                td.actual_platform, td.actual_line, td.actual_route, td.actual_variation_status, td.actual_variation, td.actual_direction, td.actual_source,
-
-                flat_schedules.uid, category, signalling_id, headcode, power_type, timing_load, speed, operating_characteristics, seating_class, sleepers,
-                reservations, catering, branding, uic_code, atoc_code,
-
-                start_date, actual_signalling_id, trust_id, current_variation,
-
-                l0.tiploc, l0.name, l0.stanox, l0.crs,
-                l1.tiploc, l1.name, l1.stanox, l1.crs,
-                l2.tiploc, l2.name, l2.stanox, l2.crs,
-                l3.tiploc, l3.name, l3.stanox, l3.crs,
-                l4.tiploc, l4.name, l4.stanox, l4.crs
-
-                FROM flat_timing
-                INNER JOIN schedule_locations ON schedule_location_iid=schedule_locations.iid
-                INNER JOIN schedules ON schedule_locations.schedule_iid=schedules.iid
-                INNER JOIN flat_schedules ON flat_timing.flat_schedule_iid=flat_schedules.iid
-
-                INNER JOIN locations as l0 ON schedule_locations.location_iid=l0.iid
-                INNER JOIN locations as l1 ON schedules.origin_location_iid=l1.iid
-                INNER JOIN locations as l2 ON schedules.destination_location_iid=l2.iid
-
-                LEFT JOIN locations as l3 ON flat_schedules.current_location=l3.iid
-                LEFT JOIN locations as l4 ON flat_schedules.cancellation_location=l4.iid
-
-                LEFT JOIN trust_movements as ta ON
-                (ta.stanox=l0.stanox AND ta.movement_type='A' AND flat_schedules.iid=ta.flat_schedule_iid AND arrival_scheduled=ta.datetime_scheduled)
-                LEFT JOIN trust_movements as td ON
-                (td.stanox=l0.stanox AND td.movement_type='D' AND flat_schedules.iid=td.flat_schedule_iid AND (departure_scheduled=td.datetime_scheduled OR pass_scheduled=td.datetime_scheduled))
-                WHERE flat_schedules.uid=%s AND flat_schedules.start_date=%s
-                ORDER BY flat_timing.schedule_location_iid;
-                """, [service_code, start_date])
-
-            for row in c:
-                row = list(row)
-                out = OrderedDict()
-                for tag in ["arrival_scheduled", "departure_scheduled", "pass_scheduled", "arrival_actual", "departure_actual"]:
-                    out[tag] = process_time(row.pop(0))
-
-                for tag in ["arrival_public", "departure_public", "platform", "line", "path", "activity", "engineering_allowance", "pathing_allowance", "performance_allowance"]:
-                    out[tag] = row.pop(0)
-
-                out["trust_arrival"] = OrderedDict([(tag,row.pop(0)) for tag in ["platform", "line", "route", "variation_status", "variation", "direction", "source"]])
-                out["trust_departure"] = OrderedDict([(tag,row.pop(0)) for tag in ["platform", "line", "route", "variation_status", "variation", "direction", "source"]])
-
-                out["service"], out["here"], out["origin"], out["destination"], out["last_location"], out["cancellation_location"] = OrderedDict(), OrderedDict(), OrderedDict(), OrderedDict(), OrderedDict(), OrderedDict()
-
-                for tag in ["uid", "category", "signalling_id", "headcode", "power_type", "timing_load", "speed", "operating_characteristics", "seating_class", "sleepers", "reservations", "catering", "branding", "uic_code", "atoc_code", "date", "actual_signalling_id", "trust_id", "current_variation"]:
-                    out["service"][tag] = row.pop(0)
-
-                out["service"]["operating_characteristics"] = out["service"]["operating_characteristics"].rstrip()
-                if out["platform"]:
-                    out["platform"] = out["platform"].rstrip()
+    def queries_issued(self):
+        return [(queries.SERVICES, services_args([(self.service_code, self.date_start)]))]
 
-                for first in ["here", "origin", "destination", "last_location", "cancellation_location"]:
-                    for second in ["tiploc", "name", "stanox", "crs"]:
-                        out[first][second] = row.pop(0)
-
-                ret.append(out)
-            return Data(schema, ret)
+    def get_board(self, start_date, service_code):
+        return get_services([(service_code, start_date)])[(service_code, start_date)]
+
+# (uid, start_date) of a raw board/service row
+service_key = itemgetter(dict(ROW_COLUMNS)["service/uid"], dict(ROW_COLUMNS)["service/date"])
+# Location iid of the stop itself, which for a board is the station that was asked for
+here_iid = itemgetter(dict(ROW_COLUMNS)["here"])
+
+def services_args(services):
+    return [[uid for uid,start_date in services], [start_date for uid,start_date in services]]
+
+def get_services(services):
+    # Any number of (uid, start_date) in one go, each gets its own Data even if there's nothing for it
+    def consume(c):
+        grouped = OrderedDict((service, []) for service in services)
+        for row in c:
+            grouped.setdefault(service_key(row), []).append(row)
+        return OrderedDict((service, decode_rows(SERVICE_SCHEMA, rows)) for service,rows in grouped.items())
+    return queries.run(queries.SERVICES, services_args(services), consume)
+
+WELCOME = [
+    ":trjd CRS [CRS ...]     departure board, more than one for a split view",
+    ":uid UID YYYY-MM-DD     service enquiry",
+    ":at HHMM                jump to a time on the board",
+    ":pool                   connection pool and query statistics",
+    ":explain                query plans for this buffer, see plans.py",
+    "/TEXT  /op=VT pt=4      search, or filter on sig op pt cat",
+    "n s p                   next match, cycle sort, timings overlay",
+    "Up Down PgUp PgDn       scroll, off either end of a board goes back or on in time",
+    "Enter  Tab  Left Right  open service, next pane, back, forward",
+    "q                       quit",
+]
+
+def warm_up():
+    # The database driver and a connection, ready before the first query wants them
+    try:
+        queries.get_pool().warm()
+    except Exception:
+        # The first query will say what's wrong
+        pass
 
 def main(stdscr):
     curses.use_default_colors()
@@ -502,69 +1782,106 @@ def main(stdscr):
     curses.init_pair(6, 0x0F,  -1)  # Bright white on default (body main)
     curses.init_pair(7, 0x0B,  -1)  # Bright yellow on default (body characteristic emphasis)
 
-    window_header = curses.newwin(1,curses.COLS, 0,0)
+    window_header = FrameWindow(curses.newwin(1,curses.COLS, 0,0))
     window_header.bkgd(" ", curses.color_pair(1))
 
-    window_subheader = curses.newwin(1,curses.COLS, 1,0)
+    window_subheader = FrameWindow(curses.newwin(1,curses.COLS, 1,0))
     window_subheader.bkgd(" ", curses.color_pair(2))
 
-    window_footer = curses.newwin(1,curses.COLS, curses.LINES-1,0)
+    window_footer = FrameWindow(curses.newwin(1,curses.COLS, curses.LINES-1,0))
     window_footer.bkgd(" ", curses.color_pair(2))
 
-    window_body = curses.newwin(curses.LINES-3,curses.COLS, 2,0)
+    window_body = FrameWindow(curses.newwin(curses.LINES-3,curses.COLS, 2,0))
     window_body.bkgd(" ", curses.color_pair(6))
+    # Let curses scroll the terminal rather than redraw every line when the board moves by one
+    window_body.idlok(True)
+
+    # The footer's left out, the overlay redraws it every frame
+    windows = [window_header, window_subheader, window_body]
 
     compose = ""
     cursor_pos = 0
     k = ""
     text_entry_mode = False
-    text_entry_invalidated = True
 
-    current_buffer = TextBuffer(
+    # What the windows were last laid out for, anything different means starting from a blank frame
+    layout = None
+    cursor_visible = None
+
+    # Started once the first screen's up, neither is needed to draw it
+    listener = None
+    started = False
+
+    history = BufferHistory(config.get("history-size", 20))
+    current_buffer = history.push(TextBuffer(
         "Welcome to BeryilliumSwallow",
-        Data({"body": ("Body", 4)}, [{"body": "line {}".format(i)} for i in range(1,80)]),
+        Data({"body": ("Commands and keys", 60)}, [{"body": line} for line in WELCOME]),
         ["body"],
-        )
+        ))
 
     while True:
         win_lines, win_cols = stdscr.getmaxyx()
         window_body_height = win_lines-2+text_entry_mode # This is a synonym for number of entries displayed
 
-        # If it's been long enough since the last refresh, new data will be pulled in!
+        if listener:
+            for payload in listener.drain():
+                history.notify(payload)
+
+        # If it's been long enough since the last refresh, or something's changed, new data will be pulled in!
         current_buffer.consider_refresh()
 
-        curses.curs_set(0) # No cursor flicker pls
+        if layout != (win_lines, win_cols, text_entry_mode, timings.overlay, current_buffer):
+            layout = (win_lines, win_cols, text_entry_mode, timings.overlay, current_buffer)
+            window_header.resize(1, win_cols)
+            window_subheader.resize(1, win_cols)
+            window_body.resize(window_body_height, win_cols)
+            window_footer.mvwin(win_lines-1, 0)
+            for window in [window_header, window_subheader, window_body, window_footer]:
+                window.reset()
+            current_buffer.invalidate()
+
+        if timings.enabled:
+            start = time.perf_counter()
+            calls = sum(window.calls for window in windows)
 
         # Header with query title
-        window_header.clear()
-        window_header.resize(1, win_cols)
-        window_subheader.clear()
-        window_subheader.resize(1, win_cols)
-
         current_buffer.render_headers(window_body_height, win_cols, window_header, window_subheader)
 
         # Window for individual entries
-        window_body.clear()
-        window_body.resize(window_body_height, win_cols)
-
         current_buffer.render(window_body, window_body_height, win_cols)
 
-        # Footer with composed command input
-        window_footer.clear()
-        if text_entry_mode:
-            window_footer.mvwin(win_lines-1, 0)
-
-            window_footer.addstr(0,0, compose)
+        window_header.flush()
+        window_subheader.flush()
+        window_body.flush()
 
+        # Footer with composed command input, last so the cursor ends up there
+        if text_entry_mode:
+            window_footer.draw_row(0, [(0, compose, 0)])
             window_footer.move(0, cursor_pos)
-
-            if text_entry_invalidated:
-                window_footer.refresh()
-
-            # Now the cursor's in position, display it
-            curses.curs_set(1)
-            # If it was invalidated, it's not any more
-            text_entry_invalidated = False
+            window_footer.flush(force=True)
+        elif timings.overlay:
+            window_footer.draw_row(0, [(0, timings.summary()[:win_cols-1], 0)])
+            window_footer.flush(force=True)
+
+        # No cursor flicker pls, unless there's something being typed
+        if cursor_visible != text_entry_mode:
+            cursor_visible = text_entry_mode
+            curses.curs_set(int(text_entry_mode))
+
+        curses.doupdate()
+
+        if not started:
+            started = True
+            if config.get("push-refresh"):
+                listener = NotificationListener(config["database-string"], config.get("notify-channel", "trust_movements"))
+            if config.get("database-string"):
+                threading.Thread(target=warm_up, daemon=True).start()
+
+        if timings.enabled:
+            calls = sum(window.calls for window in windows) - calls
+            # Frames where nothing changed aren't worth a line in the log
+            if calls:
+                timings.record("render", time.perf_counter()-start, calls=calls)
 
         k = stdscr.getch()
         if k == curses.KEY_RESIZE:
@@ -576,11 +1893,9 @@ def main(stdscr):
                 if cursor_pos:
                     compose = compose[:cursor_pos-1] + compose[cursor_pos:]
                     cursor_pos -= 1
-                    text_entry_invalidated = True
             elif k == 0x14A:
                 if cursor_pos:
                     compose = compose[:cursor_pos] + compose[cursor_pos+1:]
-                    text_entry_invalidated = True
             elif k == curses.KEY_LEFT:
                 cursor_pos = max(cursor_pos-1, 0)
             elif k == curses.KEY_RIGHT:
@@ -590,13 +1905,38 @@ def main(stdscr):
             #    cursor_pos = len(compose)
             elif k == curses.KEY_ENTER or k == 0x0A:
                 if compose.lower().startswith("trjd "):
-                    crs = compose.split(" ")[1].upper()
+                    crs = compose.upper().split()[1:]
                     dt_now = datetime.datetime.now() - datetime.timedelta(minutes=10)
-                    current_buffer = BoardBuffer(dt_now, 120, crs)
+                    if shared_snapshots:
+                        # Clients only share boards for the same window, so give them a chance of asking for one
+                        dt_now = dt_now.replace(minute=dt_now.minute - dt_now.minute%5, second=0, microsecond=0)
+                    if len(crs) > 1:
+                        current_buffer = history.push(SplitBoardBuffer(dt_now, 120, crs))
+                    elif crs:
+                        current_buffer = history.push(BoardBuffer(dt_now, 120, crs[0]))
                 elif compose.lower().startswith("uid "):
                     uid = compose.split(" ")[1].upper()
                     start_date = datetime.datetime.strptime(compose.split(" ")[2], "%Y-%m-%d").date()
-                    current_buffer = ServiceBuffer(start_date, uid)
+                    current_buffer = history.push(ServiceBuffer(start_date, uid))
+                elif compose.startswith("/"):
+                    current_buffer.find(compose[1:], window_body_height)
+                elif compose.lower().startswith("at "):
+                    # at 1430, or 14:30. Anything else does nothing
+                    current_buffer.jump_to_time(compose[3:].strip().replace(":", ""), window_body_height)
+                elif compose.lower().strip() == "pool":
+                    stats = [{"stat": k, "value": v} for k,v in queries.get_pool().stats.items()]
+                    stats += [{"stat": "location cache " + k, "value": v} for k,v in location_cache.stats.items()]
+                    stats.append({"stat": "location cache size", "value": len(location_cache.locations)})
+                    # Comparing prepared against plain execution times is what shows up planning costs
+                    for (name, prepared), (executions, seconds) in queries.query_stats.timings.items():
+                        stats.append({"stat": "{} ({})".format(name, "prepared" if prepared else "plain"), "value": "{:.1f}ms".format(seconds/executions*1000)})
+                    current_buffer = history.push(TextBuffer(
+                        "DATABASE CONNECTION POOL",
+                        Data({"stat": ("stat", 28), "value": ("value", 10, str.rjust)}, stats),
+                        ["stat", "value"],
+                        ))
+                elif compose.lower().strip() == "explain":
+                    current_buffer = history.push(ExplainBuffer(current_buffer, win_cols-1))
 
                 compose = ""
                 cursor_pos = 0
@@ -605,17 +1945,50 @@ def main(stdscr):
                 if cursor_pos < win_cols-1:
                     compose = compose[:cursor_pos] + chr(k) + compose[cursor_pos:]
                     cursor_pos += 1
-                    text_entry_invalidated = True
                 else:
                     curses.beep()
         else:
             if k == ord("t") or k == ord(":"):
                 text_entry_mode = True
+            elif k == ord("/"):
+                # Straight into typing a search
+                text_entry_mode = True
+                compose, cursor_pos = "/", 1
+            elif k == ord("n"):
+                current_buffer.search_next(window_body_height)
+            elif k == ord("s"):
+                current_buffer.cycle_sort()
+            elif k == curses.KEY_NPAGE:
+                current_buffer.move_selection(window_body_height, window_body_height)
+            elif k == curses.KEY_PPAGE:
+                current_buffer.move_selection(-window_body_height, window_body_height)
             elif k == ord("q"):
                 break
             elif k == curses.KEY_DOWN:
-                current_buffer.scroll_down(1)
+                current_buffer.move_selection(1, window_body_height)
             elif k == curses.KEY_UP:
-                current_buffer.scroll_up(1)
-
-curses.wrapper(main)
+                current_buffer.move_selection(-1, window_body_height)
+            elif k == ord("p"):
+                # Timings overlay in the footer
+                timings.toggle_overlay()
+            elif k == 0x09: # Tab
+                current_buffer.next_pane()
+            elif k == curses.KEY_ENTER or k == 0x0A:
+                opened = current_buffer.open_selected()
+                if opened:
+                    current_buffer = history.push(opened)
+            elif k == curses.KEY_LEFT:
+                current_buffer = history.back()
+            elif k == curses.KEY_RIGHT:
+                current_buffer = history.forward()
+            elif k == -1:
+                # getch timed out, so there's a moment spare
+                current_buffer.consider_prefetch()
+
+if __name__ == "__main__":
+    import curses
+    try:
+        curses.wrapper(main)
+    finally:
+        if queries.pool:
+            queries.pool.close()
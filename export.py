@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+
+# Boards and services as JSON Lines or CSV on stdout, for feeding other things rather than reading:
+#   ./export.py board EUS --duration 60 --format csv
+#   ./export.py service C12345 2024-01-01
+#   ./export.py board EUS --follow
+# Rows are written as they're fetched. With --follow it keeps refreshing and only writes rows that have changed
+
+import argparse, csv, datetime, json, sys, time
+from collections import OrderedDict
+from itertools import islice
+
+import client_curses as cc
+import queries
+from queries import config
+
+# Whatever the buffer shows, these come first so every row says which train it is
+KEY_COLUMNS = ["service/uid", "service/date"]
+
+class Export():
+    # Mixed into a buffer so it waits to be fetched for, rather than starting a refresh thread of its own
+    def load(self, empty):
+        self.apply(empty)
+
+class ExportBoard(Export, cc.BoardBuffer):
+    pass
+
+class ExportService(Export, cc.ServiceBuffer):
+    pass
+
+def row_key(row):
+    return (row["service"]["iid"],) + tuple(row[tag]["ut"] for tag in ["arrival_scheduled", "departure_scheduled", "pass_scheduled"])
+
+class RowWriter():
+    def __init__(self, buffer, format, out):
+        self.buffer, self.out = buffer, out
+        self.columns = KEY_COLUMNS + [column for column in buffer.format if column not in KEY_COLUMNS]
+        self.getters = [(column, cc.column_getter(column.split("/"))) for column in self.columns]
+        self.csv = csv.writer(out) if format == "csv" else None
+        if self.csv:
+            self.csv.writerow(self.columns)
+
+    def values(self, row):
+        # What the screen would show, live data and all, just not padded out
+        values = []
+        for column, get in self.getters:
+            value = get(row)
+            if value is not None:
+                value = self.buffer.substitute_fn(row, column, (str(value), 0))[0].strip()
+            values.append(value)
+        return values
+
+    def line(self, row):
+        if self.csv:
+            return ["" if value is None else value for value in self.values(row)]
+        return json.dumps(OrderedDict(zip(self.columns, self.values(row))))
+
+    def write(self, line):
+        if self.csv:
+            self.csv.writerow(line)
+        else:
+            self.out.write(line + "\n")
+
+class Exporter():
+    def __init__(self, buffer, writer, out):
+        self.buffer, self.writer, self.out = buffer, writer, out
+        # row key -> what was last written for it, only ever as big as the board
+        self.written = {}
+        self.streamed = 0
+        buffer.post_progress = self.progress
+
+    def progress(self, data):
+        # Called after every batch the cursor gives, so rows go out before the query's finished
+        for row in islice(data.data, self.streamed, None):
+            self.emit(row, self.written)
+        self.streamed = len(data.data)
+        self.out.flush()
+
+    def emit(self, row, written):
+        key, line = row_key(row), self.writer.line(row)
+        if self.written.get(key) != line:
+            self.writer.write(line)
+        written[key] = line
+
+    def refresh(self):
+        self.streamed = 0
+        self.buffer.apply(self.buffer.fetch())
+        written = {}
+        for row in self.buffer.data.data:
+            self.emit(row, written)
+        # Rows that have left the board are forgotten
+        self.written = written
+        self.out.flush()
+
+def follow(exporter, args):
+    buffer = exporter.buffer
+    listener = None
+    if config.get("push-refresh"):
+        listener = cc.NotificationListener(config["database-string"], config.get("notify-channel", "trust_movements"))
+    last = time.monotonic()
+    while True:
+        time.sleep(0.5)
+        if listener:
+            for payload in listener.drain():
+                buffer.notify(payload)
+        since = time.monotonic()-last
+        # Same rules as the interactive client: poll every so often, or shortly after a relevant notification
+        if since >= args.interval or (buffer.push_pending and since >= 2):
+            buffer.push_pending = False
+            last = time.monotonic()
+            if args.start is None and isinstance(buffer, cc.BoardBuffer):
+                # The window keeps up with the clock, it takes effect on the next full refresh
+                buffer.dt_start = datetime.datetime.now() - datetime.timedelta(minutes=10)
+            exporter.refresh()
+
+def main():
+    # Either command takes these, after its own arguments
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("--format", choices=["jsonl", "csv"], default="jsonl")
+    common.add_argument("--follow", action="store_true", help="keep refreshing, writing only rows that change")
+    common.add_argument("--interval", type=float, default=30, help="seconds between refreshes with --follow")
+    parser = argparse.ArgumentParser(description="Export boards and services without the curses client")
+    commands = parser.add_subparsers(dest="command", required=True)
+    board = commands.add_parser("board", parents=[common], help="a station's departures")
+    board.add_argument("crs")
+    board.add_argument("--start", type=datetime.datetime.fromisoformat, help="default ten minutes ago")
+    board.add_argument("--duration", type=int, default=120, help="minutes")
+    service = commands.add_parser("service", parents=[common], help="a service's calling points")
+    service.add_argument("uid")
+    service.add_argument("date", type=datetime.date.fromisoformat)
+    args = parser.parse_args()
+
+    if args.command == "board":
+        start = args.start or datetime.datetime.now() - datetime.timedelta(minutes=10)
+        buffer = ExportBoard(start, args.duration, args.crs.upper())
+    else:
+        args.start = None
+        buffer = ExportService(args.date, args.uid.upper())
+
+    exporter = Exporter(buffer, RowWriter(buffer, args.format, sys.stdout), sys.stdout)
+    try:
+        exporter.refresh()
+        if args.follow:
+            follow(exporter, args)
+    except (KeyboardInterrupt, BrokenPipeError):
+        pass
+    finally:
+        if queries.pool:
+            queries.pool.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,24 @@
+-- Lets clients with "push-refresh" enabled hear about live data as it lands, rather than polling for it.
+-- The channel name has to match "notify-channel" in the client's config.json. test_notify.py checks it all works against a test database.
+
+CREATE OR REPLACE FUNCTION notify_trust_movement() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('trust_movements', json_build_object('stanox', NEW.stanox, 'flat_schedule_iid', NEW.flat_schedule_iid)::text);
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION notify_flat_schedule() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('trust_movements', json_build_object('flat_schedule_iid', NEW.iid)::text);
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trust_movements_notify ON trust_movements;
+CREATE TRIGGER trust_movements_notify AFTER INSERT OR UPDATE ON trust_movements
+    FOR EACH ROW EXECUTE PROCEDURE notify_trust_movement();
+
+DROP TRIGGER IF EXISTS flat_schedules_notify ON flat_schedules;
+CREATE TRIGGER flat_schedules_notify AFTER UPDATE OF current_variation, actual_signalling_id ON flat_schedules
+    FOR EACH ROW EXECUTE PROCEDURE notify_flat_schedule();
@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+
+# EXPLAIN (ANALYZE, BUFFERS) for exactly the queries a board or service does, and which indexes they look to be missing:
+#   ./plans.py board EUS
+#   ./plans.py service C12345 2024-01-01
+#   ./plans.py history board
+# Every plan's kept in plan-log with its timings, so what an index did can be compared with how it was before.
+# The same report's :explain in the client. synthetic.sql makes a database of made up timetables to try it on
+
+import argparse, datetime, hashlib, json, re, time
+from collections import OrderedDict, namedtuple
+
+import queries
+from queries import config
+
+# Seq scans reading fewer rows than this are reported, but an index isn't suggested for them
+MIN_ROWS = config.get("plan-min-rows", 1000)
+# A scan whose own conditions keep less than this much of what it reads wants an index on those, not on what it's joined on
+SELECTIVE = config.get("plan-selective", 0.1)
+
+Finding = namedtuple("Finding", ["relation", "detail", "ddl"])
+
+# Where a node's conditions are, and the ones that say how it's joined to whatever's above it
+SCAN_CONDITIONS = ["Index Cond", "Recheck Cond", "Filter"]
+JOIN_CONDITIONS = ["Hash Cond", "Merge Cond", "Join Filter"]
+# Nodes that only hold on to what's under them, so whatever's under them is as good as joined directly
+PASS_THROUGH = {"Hash", "Materialize", "Memoize"}
+OPERATORS = re.compile(r"\s(=|<>|<=|>=|<|>)\s")
+# A column on its own, maybe qualified and cast: ta.movement_type, (uid)::text
+COLUMN = re.compile(r"^\(*(?:(\w+)\.)?([a-z_]\w*)\)*(?:::[\w ]+)?\)*$")
+
+def unwrap(text):
+    # Without any brackets that go round the whole of it
+    text = text.strip()
+    while text.startswith("("):
+        depth = 0
+        for i,c in enumerate(text):
+            depth += {"(": 1, ")": -1}.get(c, 0)
+            if not depth:
+                break
+        if i != len(text)-1:
+            break
+        text = text[1:-1].strip()
+    return text
+
+def split_top(text, word):
+    # text's parts either side of every word that isn't inside brackets
+    parts, depth, start = [], 0, 0
+    for i,c in enumerate(text):
+        depth += {"(": 1, ")": -1}.get(c, 0)
+        if not depth and text.startswith(word, i):
+            parts.append(text[start:i])
+            start = i+len(word)
+    return parts + [text[start:]]
+
+def terms(condition):
+    # What's ANDed together, however it's bracketed. An OR of things can't be looked up with an index, so those are left out
+    parts = split_top(unwrap(condition), " AND ")
+    if len(parts) == 1:
+        return [] if len(split_top(parts[0], " OR ")) > 1 else [unwrap(parts[0])]
+    return [term for part in parts for term in terms(part)]
+
+def comparisons(condition):
+    # (alias or None, column, operator) for every column compared with something, either side
+    for term in terms(condition):
+        parts = OPERATORS.split(term, 1)
+        if len(parts) != 3:
+            continue
+        lhs, operator, rhs = parts
+        for side in (lhs, rhs):
+            match = COLUMN.match(side.strip())
+            if match and match.group(2) not in ("true", "false", "null"):
+                yield match.group(1), match.group(2), operator
+
+def index_for(node, joins):
+    # Columns an index would want to be of use to this scan: its own equalities, what it's joined on, then one range.
+    # Its own are mostly constants, first so that an index for one join can start with what another wants
+    alias = node.get("Alias", node.get("Relation Name"))
+    equal, ranges = [], []
+    owned = [(node.get(key), True) for key in SCAN_CONDITIONS] + [(condition, False) for condition in joins]
+    for condition, own in owned:
+        if not condition:
+            continue
+        for qualifier, column, operator in comparisons(condition):
+            # A scan's own conditions are mostly unqualified, a join's always say which side's which
+            if qualifier != alias and not (own and qualifier is None):
+                continue
+            if operator == "=":
+                equal.append(column)
+            elif operator != "<>":
+                ranges.append(column)
+    columns = list(OrderedDict.fromkeys(equal))
+    return columns + [column for column in ranges if column not in columns][:1]
+
+def usable(indexes, columns):
+    # Any index that starts with one of them would do for a start
+    return [index for index in indexes if index and index[0] in columns]
+
+def create_index(table, columns):
+    name = "{}_{}_idx".format(table, "_".join(columns))
+    # Postgres would cut it to 63 bytes, which could be some other index's name, and IF NOT EXISTS would say nothing
+    if len(name.encode()) > 63:
+        name = "{}_{}_idx".format(name[:50], hashlib.sha1(name.encode()).hexdigest()[:8])
+    return "CREATE INDEX CONCURRENTLY IF NOT EXISTS {} ON {} ({});".format(name, table, ", ".join(columns))
+
+def nodes(plan, inner=(), nearest=()):
+    # Every node, with the conditions of the nested loop it's on the inner side of, so is looked up by, and those of the join
+    # it's directly under. A hash or merge join's inner side is read the once, it's only looked up in a nested loop.
+    # Anything further down is in another join of its own, and an index on those columns wouldn't help it
+    yield plan, inner, nearest
+    own = tuple(plan[key] for key in JOIN_CONDITIONS if key in plan)
+    for child in plan.get("Plans", []):
+        if plan["Node Type"] in PASS_THROUGH:
+            yield from nodes(child, inner, nearest)
+        else:
+            looked_up = plan["Node Type"] == "Nested Loop" and child.get("Parent Relationship") == "Inner"
+            yield from nodes(child, own if looked_up else (), own)
+
+def scanned(node):
+    # Rows and rows removed are both per loop
+    return (node.get("Actual Rows", 0) + node.get("Rows Removed by Filter", 0)) * node.get("Actual Loops", 1)
+
+def selective(node):
+    return node.get("Actual Rows", 0) * node.get("Actual Loops", 1) < SELECTIVE * scanned(node)
+
+def findings(plan, indexes):
+    # Seq scans, index scans throwing most of what they read away, and sorts that didn't fit in work_mem
+    found = []
+    # position in found -> (table, columns) of the index it suggests
+    wanted = {}
+    for node, inner, nearest in nodes(plan):
+        table = node.get("Relation Name")
+        name = "{} ({})".format(table, node["Alias"]) if table and node.get("Alias", table) != table else table
+        if node["Node Type"] == "Seq Scan":
+            # Looked up by a nested loop, or read in full for a join and hardly narrowed down by its own conditions, an index on
+            # what it's joined on would let it be looked up instead. Otherwise what it's joined on would only get in the way of
+            # the index its own conditions want, ahead of their range
+            columns = index_for(node, inner or (() if selective(node) else nearest))
+            detail = "seq scan on {}, {} rows read for {}".format(name, scanned(node), node.get("Actual Rows", 0) * node.get("Actual Loops", 1))
+            existing = usable(indexes.get(table, []), columns)
+            if not columns:
+                found.append(Finding(table, detail + ", nothing to index on", None))
+            elif existing:
+                found.append(Finding(table, detail + ", though there's an index on ({}), ANALYZE it or it's too small to bother".format(", ".join(existing[0])), None))
+            elif scanned(node) < MIN_ROWS:
+                found.append(Finding(table, detail + ", too few to need an index", None))
+            else:
+                wanted[len(found)] = (table, columns)
+                found.append(Finding(table, detail + ", no index on ({})".format(", ".join(columns)), create_index(table, columns)))
+        elif node["Node Type"] in ("Index Scan", "Index Only Scan", "Bitmap Heap Scan") and node.get("Rows Removed by Filter", 0) >= max(MIN_ROWS, node.get("Actual Rows", 0)):
+            columns = index_for(node, inner)
+            if not any(index[:len(columns)] == columns for index in indexes.get(table, [])):
+                wanted[len(found)] = (table, columns)
+                found.append(Finding(table, "{} on {} throws away {} of {} rows it reads".format(node["Node Type"].lower(), name,
+                    node["Rows Removed by Filter"] * node.get("Actual Loops", 1), scanned(node)), create_index(table, columns)))
+        elif node.get("Sort Space Type") == "Disk":
+            found.append(Finding(None, "sort went to disk, {}kB, more work_mem would keep it in memory".format(node.get("Sort Space Used")), None))
+    # Both of trust_movements' joins can use the one index, the one that starts with what the other wants
+    for i,(table, columns) in wanted.items():
+        if any(j != i and other[0] == table and other[1][:len(columns)] == columns and (other[1] != columns or j < i) for j,other in wanted.items()):
+            found[i] = found[i]._replace(ddl=None)
+    return found
+
+def plan_lines(node, depth=0):
+    # One line a node, indented under its parent
+    label = node["Node Type"]
+    if "Relation Name" in node:
+        label += " on " + node["Relation Name"] + (" " + node["Alias"] if node.get("Alias", node["Relation Name"]) != node["Relation Name"] else "")
+    if "Index Name" in node:
+        label += " using " + node["Index Name"]
+    yield "{}{}  {:.2f}ms rows={} loops={} hit={} read={}".format("  "*depth, label, node.get("Actual Total Time", 0), node.get("Actual Rows"),
+        node.get("Actual Loops"), node.get("Shared Hit Blocks", 0), node.get("Shared Read Blocks", 0))
+    for child in node.get("Plans", []):
+        yield from plan_lines(child, depth+1)
+
+class PlanLog():
+    # A JSON line per plan, with the arguments it ran with and how long it took
+    def __init__(self, path):
+        self.path = path
+
+    def append(self, record):
+        if self.path:
+            with open(self.path, "a") as f:
+                f.write(json.dumps(record, default=str) + "\n")
+
+    def history(self, name=None):
+        try:
+            with open(self.path) as f:
+                records = [json.loads(line) for line in f if line.strip()]
+        except (FileNotFoundError, TypeError):
+            return []
+        return [record for record in records if name in (None, record["name"])]
+
+plan_log = PlanLog(config.get("plan-log", "plan_history.jsonl"))
+
+def capture(statement, args):
+    explained = queries.explain(statement, args)
+    plan = explained["Plan"]
+    indexes = queries.index_columns({node["Relation Name"] for node, inner, nearest in nodes(plan) if "Relation Name" in node})
+    return OrderedDict([
+        ("at", round(time.time(), 3)), ("name", statement.name), ("args", args),
+        ("execution_ms", explained.get("Execution Time")), ("planning_ms", explained.get("Planning Time")),
+        ("rows", plan.get("Actual Rows")), ("hit", plan.get("Shared Hit Blocks", 0)), ("read", plan.get("Shared Read Blocks", 0)),
+        ("findings", [finding._asdict() for finding in findings(plan, indexes)]),
+        ("plan", plan),
+    ])
+
+def explain_buffer(buffer, log=None):
+    records = [capture(statement, args) for statement, args in buffer.queries_issued()]
+    for record in records:
+        (log or plan_log).append(record)
+    return records
+
+def report(records, log):
+    lines = []
+    for record in records:
+        lines.append("{name}  {execution_ms:.1f}ms  planning {planning_ms:.1f}ms  rows={rows} hit={hit} read={read}".format(**record))
+        # The latest few before this one, to see whether things got better
+        before = [previous for previous in log.history(record["name"]) if previous["at"] < record["at"]][-config.get("plan-history", 5):]
+        if before:
+            lines.append("  before: " + ", ".join("{:.1f}ms {:%m-%d %H:%M}".format(previous["execution_ms"], datetime.datetime.fromtimestamp(previous["at"])) for previous in reversed(before)))
+        for finding in record["findings"]:
+            lines.append("  ! " + finding["detail"])
+            if finding["ddl"]:
+                lines.append("    " + finding["ddl"])
+        lines.extend("  " + line for line in plan_lines(record["plan"]))
+        lines.append("")
+    return lines
+
+def main():
+    parser = argparse.ArgumentParser(description="Query plans for the client's board and service queries")
+    commands = parser.add_subparsers(dest="command", required=True)
+    board = commands.add_parser("board", help="a station's departures, and the polls in between")
+    board.add_argument("crs")
+    board.add_argument("--start", type=datetime.datetime.fromisoformat, help="default ten minutes ago")
+    board.add_argument("--duration", type=int, default=120, help="minutes")
+    service = commands.add_parser("service", help="a service's calling points")
+    service.add_argument("uid")
+    service.add_argument("date", type=datetime.date.fromisoformat)
+    history = commands.add_parser("history", help="timings of earlier plans")
+    history.add_argument("name", nargs="?", help="board, services, movements_since...")
+    args = parser.parse_args()
+
+    if args.command == "history":
+        for record in plan_log.history(args.name):
+            print("{:%Y-%m-%d %H:%M:%S}  {:<16} {:>9.1f}ms  {} findings".format(datetime.datetime.fromtimestamp(record["at"]), record["name"], record["execution_ms"], len(record["findings"])))
+        return
+
+    # Buffers as export.py has them, fetched for once so there's rows to base the polls on
+    import export
+    if args.command == "board":
+        start = args.start or datetime.datetime.now() - datetime.timedelta(minutes=10)
+        buffer = export.ExportBoard(start, args.duration, args.crs.upper())
+    else:
+        buffer = export.ExportService(args.date, args.uid.upper())
+    try:
+        buffer.apply(buffer.fetch())
+        for line in report(explain_buffer(buffer), plan_log):
+            print(line)
+    finally:
+        if queries.pool:
+            queries.pool.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,328 @@
+import json, re, threading, time
+from collections import OrderedDict
+
+# psycopg2's imported when it's first needed, it's a good part of startup otherwise
+
+def load_config(path="config.json"):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+config = load_config()
+
+class ConnectionPool():
+    def __init__(self, dsn, size):
+        # size is how many connections there can be at once, idle or not. Anything wanting one when they're all in use waits for one
+        self.dsn, self.size = dsn, size
+        self.idle = []
+        self.open = 0
+        self.lock = threading.Lock()
+        self.available = threading.Condition(self.lock)
+        self.stats = OrderedDict([("hits", 0), ("misses", 0), ("waits", 0), ("reconnects", 0)])
+        # id(connection) -> names of statements PREPAREd on it, they last as long as the session
+        self.prepared = {}
+        # The connection this thread's in the middle of using, if any. Decoding a board looks locations up as it goes,
+        # and waiting on a second connection for that could wait forever
+        self.local = threading.local()
+
+    def acquire(self, fresh=False):
+        # fresh is for when the idle ones are suspect, they're all closed and a new one made
+        with self.available:
+            while True:
+                if fresh:
+                    self.discard_idle()
+                if self.idle:
+                    self.stats["hits"] += 1
+                    return self.idle.pop()
+                if self.open < self.size:
+                    break
+                self.stats["waits"] += 1
+                self.available.wait()
+            self.stats["misses"] += 1
+            self.open += 1
+        try:
+            connection = self.connect()
+        except BaseException:
+            with self.available:
+                self.forget(None)
+            raise
+        with self.lock:
+            self.prepared[id(connection)] = set()
+        return connection
+
+    def connect(self):
+        import psycopg2
+        return psycopg2.connect(self.dsn)
+
+    def forget(self, connection):
+        # Makes room for another, with the lock held
+        if connection is not None:
+            self.prepared.pop(id(connection), None)
+        self.open -= 1
+        self.available.notify()
+
+    def discard_idle(self):
+        # Also with the lock held
+        idle, self.idle = self.idle, []
+        for connection in idle:
+            self.forget(connection)
+            connection.close()
+
+    def release(self, connection):
+        import psycopg2
+        try:
+            # Don't leave the backend sat idle in a transaction between refreshes
+            connection.rollback()
+        except psycopg2.Error:
+            pass
+        with self.available:
+            if not connection.closed:
+                self.idle.append(connection)
+                self.available.notify()
+                return
+            self.forget(connection)
+        connection.close()
+
+    def prepared_on(self, connection):
+        with self.lock:
+            return self.prepared.setdefault(id(connection), set())
+
+    def warm(self):
+        self.release(self.acquire())
+
+    def run(self, fn, name=None):
+        import psycopg2
+        held = getattr(self.local, "connection", None)
+        if held is not None:
+            # Already got one, whatever it's doing it's in this thread so it can wait
+            with held.cursor(name) as c:
+                c.itersize = config.get("cursor-itersize", 500)
+                return fn(c)
+        # Queries are read-only, so if the server's dropped the connection it's safe to run them again on another.
+        # If it's restarted every idle one's as dead as the first, so it's only given up on once a new one's failed too
+        fresh = False
+        while True:
+            connection = self.acquire(fresh)
+            self.local.connection = connection
+            try:
+                # A name makes it a server-side cursor, so results come over in batches rather than all at once
+                with connection.cursor(name) as c:
+                    c.itersize = config.get("cursor-itersize", 500)
+                    return fn(c)
+            except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                if not connection.closed or fresh:
+                    raise
+                with self.lock:
+                    self.stats["reconnects"] += 1
+                fresh = True
+            finally:
+                self.local.connection = None
+                self.release(connection)
+
+    def close(self):
+        with self.available:
+            self.discard_idle()
+
+pool = None
+pool_lock = threading.Lock()
+
+def get_pool():
+    global pool
+    # Refresh workers can get here at the same time
+    with pool_lock:
+        if not pool:
+            pool = ConnectionPool(config["database-string"], config.get("database-pool-size", 2))
+    return pool
+
+class Statement():
+    # Written with $n placeholders, as PREPARE wants them. A streamed one's results can be big enough to want a
+    # server-side cursor, which a PREPAREd statement can't be run through, so those are never prepared
+    def __init__(self, name, sql, streamed=False):
+        self.name, self.sql, self.streamed = name, sql, streamed
+        self.arity = len(set(re.findall(r"\$\d+", sql)))
+        # Placeholders are only ever used once and in order, so this is all a plain execute needs
+        self.client_sql = re.sub(r"\$\d+", "%s", sql)
+
+def row_query(where, order, match_stanox):
+    # Every board and service query returns these columns in this order, decode_row depends on it
+    # Locations come back as iids only, the client fills them in from location_cache
+    stanox = "{0}.stanox=l0.stanox AND " if match_stanox else ""
+    # Still needed to match movements up to the right stop, but nothing's selected from it
+    join = "        INNER JOIN locations as l0 ON schedule_locations.location_iid=l0.iid\n" if match_stanox else ""
+    return """SELECT
+        arrival_scheduled,departure_scheduled,pass_scheduled,
+        ta.datetime_actual,td.datetime_actual,
+        arrival_public, departure_public,
+        platform, line, path, activity, engineering_allowance, pathing_allowance, performance_allowance,
+        ta.actual_platform, ta.actual_line, ta.actual_route, ta.actual_variation_status, ta.actual_variation, ta.actual_direction, ta.actual_source,
+        td.actual_platform, td.actual_line, td.actual_route, td.actual_variation_status, td.actual_variation, td.actual_direction, td.actual_source,
+
+        flat_schedules.uid, category, signalling_id, headcode, power_type, timing_load, speed, operating_characteristics, seating_class, sleepers,
+        reservations, catering, branding, uic_code, atoc_code,
+
+        start_date, actual_signalling_id, trust_id, current_variation,
+
+        schedule_locations.location_iid, schedules.origin_location_iid, schedules.destination_location_iid,
+        flat_schedules.current_location, flat_schedules.cancellation_location,
+
+        flat_schedules.iid
+
+        FROM flat_timing
+        INNER JOIN schedule_locations ON schedule_location_iid=schedule_locations.iid
+        INNER JOIN schedules ON schedule_locations.schedule_iid=schedules.iid
+        INNER JOIN flat_schedules ON flat_timing.flat_schedule_iid=flat_schedules.iid
+{join}
+        LEFT JOIN trust_movements as ta ON
+        ({ta}ta.movement_type='A' AND flat_schedules.iid=ta.flat_schedule_iid AND arrival_scheduled=ta.datetime_scheduled)
+        LEFT JOIN trust_movements as td ON
+        ({td}td.movement_type='D' AND flat_schedules.iid=td.flat_schedule_iid AND (departure_scheduled=td.datetime_scheduled OR pass_scheduled=td.datetime_scheduled))
+        WHERE {where}
+        ORDER BY {order}""".format(join=join, ta=stanox.format("ta"), td=stanox.format("td"), where=where, order=order)
+
+# location_iid, from, to
+BOARD = Statement("board", row_query(
+    "flat_timing.location_iid=$1 AND departure_scheduled BETWEEN $2 AND $3",
+    "departure_scheduled", False), True)
+
+# location_iids, from, to. Several boards in one go, told apart by the stop's location_iid
+BOARDS = Statement("boards", row_query(
+    "flat_timing.location_iid=ANY($1) AND departure_scheduled BETWEEN $2 AND $3",
+    "departure_scheduled", False), True)
+
+# uids, start_dates, as parallel arrays
+SERVICES = Statement("services", row_query(
+    "(flat_schedules.uid, flat_schedules.start_date) IN (SELECT * FROM unnest($1::text[], $2::date[]))",
+    "flat_schedules.uid, flat_schedules.start_date, flat_timing.schedule_location_iid", True), True)
+
+# flat_schedule_iids, movements after
+MOVEMENTS_SINCE = Statement("movements_since", """SELECT
+    flat_schedule_iid, movement_type, datetime_scheduled, datetime_actual,
+    actual_platform, actual_line, actual_route, actual_variation_status, actual_variation, actual_direction, actual_source
+    FROM trust_movements
+    WHERE flat_schedule_iid=ANY($1) AND datetime_actual>$2""")
+
+# flat_schedule_iids
+SCHEDULE_LIVE = Statement("schedule_live", "SELECT iid, actual_signalling_id, current_variation FROM flat_schedules WHERE iid=ANY($1)")
+
+# crs
+LOCATION_IID = Statement("location_iid", "SELECT iid FROM locations WHERE crs=$1")
+
+# iids
+LOCATIONS = Statement("locations", "SELECT iid, tiploc, name, stanox, crs FROM locations WHERE iid=ANY($1)")
+
+# Called with (statement name, whether it was prepared, seconds) after every execute
+query_hooks = []
+
+class QueryStats():
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (name, prepared) -> [executions, total seconds]
+        self.timings = OrderedDict()
+
+    def __call__(self, name, prepared, seconds):
+        with self.lock:
+            timing = self.timings.setdefault((name, prepared), [0, 0.0])
+            timing[0] += 1
+            timing[1] += seconds
+
+query_stats = QueryStats()
+query_hooks.append(query_stats)
+
+def execute(c, statement, args):
+    start = time.perf_counter()
+    prepared = config.get("prepared-statements", True) and not statement.streamed
+    if prepared:
+        names = get_pool().prepared_on(c.connection)
+        if statement.name not in names:
+            c.execute("PREPARE {} AS {};".format(statement.name, statement.sql))
+            names.add(statement.name)
+        c.execute("EXECUTE {}({});".format(statement.name, ", ".join(["%s"]*statement.arity)), args)
+    else:
+        c.execute(statement.client_sql + ";", args)
+    for hook in query_hooks:
+        hook(statement.name, prepared, time.perf_counter()-start)
+
+def run(statement, args, consume):
+    def query(c):
+        execute(c, statement, args)
+        return consume(c)
+    return get_pool().run(query, statement.name if statement.streamed else None)
+
+def explain(statement, args):
+    # Runs it for real, so the plan has actual times, rows and buffers in it. JSON so plans.py can pick it apart
+    def query(c):
+        c.execute("EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) " + statement.client_sql + ";", args)
+        plan, = c.fetchone()
+        return (json.loads(plan) if isinstance(plan, str) else plan)[0]
+    return get_pool().run(query)
+
+def index_columns(tables):
+    # table -> the columns of each of its indexes, in order
+    def query(c):
+        c.execute("""SELECT t.relname, array_agg(a.attname::text ORDER BY k.n)
+            FROM pg_index i
+            INNER JOIN pg_class t ON t.oid=i.indrelid
+            CROSS JOIN LATERAL unnest(i.indkey) WITH ORDINALITY AS k(attnum, n)
+            INNER JOIN pg_attribute a ON a.attrelid=t.oid AND a.attnum=k.attnum
+            WHERE t.relname=ANY(%s) AND pg_table_is_visible(t.oid)
+            GROUP BY t.relname, i.indexrelid;""", [list(tables)])
+        indexes = {table: [] for table in tables}
+        for table, columns in c:
+            indexes[table].append(columns)
+        return indexes
+    return get_pool().run(query)
+
+crs_iids = {}
+
+def location_iid(crs):
+    # Locations hardly ever change, so there's no need to look one up every refresh
+    if crs not in crs_iids:
+        def consume(c):
+            row = c.fetchone()
+            return row[0] if row else None
+        crs_iids[crs] = run(LOCATION_IID, [crs], consume)
+    return crs_iids[crs]
+
+class LocationCache():
+    # iid -> whatever make builds from (tiploc, name, stanox, crs), shared by every row that mentions it
+    def __init__(self, make, ttl):
+        self.make, self.ttl = make, ttl
+        self.lock = threading.Lock()
+        self.locations = {}
+        # iids looked up since the ttl last ran out, the rest of locations is kept until they're replaced so other threads never see a gap
+        self.fresh = set()
+        self.empty = make(None, None, None, None)
+        self.loaded = time.monotonic()
+        self.stats = OrderedDict([("hits", 0), ("misses", 0), ("loads", 0)])
+
+    def resolve(self, iids):
+        # Fetches whichever of iids aren't cached yet, in one query
+        iids = set(iids)
+        iids.discard(None)
+        with self.lock:
+            if time.monotonic() - self.loaded > self.ttl:
+                self.fresh = set()
+                self.loaded = time.monotonic()
+            missing = [iid for iid in iids if iid not in self.fresh]
+            self.stats["hits"] += len(iids) - len(missing)
+            self.stats["misses"] += len(missing)
+        if not missing:
+            return
+        found = {iid: self.make(*fields) for iid, *fields in run(LOCATIONS, [missing], lambda c: c.fetchall())}
+        with self.lock:
+            self.stats["loads"] += 1
+            # Ones that don't exist are remembered as empty, so there's no going back for them
+            for iid in missing:
+                self.locations[iid] = found.get(iid, self.empty)
+            self.fresh.update(missing)
+
+    def seed(self, locations):
+        # iid -> location, as another process had them. Only used until this one's looked them up itself
+        with self.lock:
+            for iid, location in locations.items():
+                self.locations.setdefault(iid, location)
+
+    def get(self, iid):
+        return self.locations.get(iid, self.empty)
@@ -0,0 +1,103 @@
+-- Made up timetables in a schema of their own, with just the columns the client reads, for trying plans.py out on:
+--   createdb swallow_test
+--   psql -d swallow_test -v services=20000 -f synthetic.sql
+-- then point the client at it in config.json:
+--   "database-string": "dbname='swallow_test' options='-c search_path=synthetic'"
+-- and ./plans.py board S01. Stations are S01, S02..., services C00001... and run from yesterday for "days" days.
+-- Only primary keys are indexed, so there's something to find. Running it again starts from scratch.
+
+\if :{?stations}
+\else
+    \set stations 200
+\endif
+\if :{?services}
+\else
+    \set services 20000
+\endif
+\if :{?stops}
+\else
+    \set stops 12
+\endif
+\if :{?days}
+\else
+    \set days 3
+\endif
+
+DROP SCHEMA IF EXISTS synthetic CASCADE;
+CREATE SCHEMA synthetic;
+SET search_path = synthetic;
+SELECT setseed(0.42);
+
+CREATE TABLE locations (iid serial PRIMARY KEY, tiploc text, name text, stanox text, crs text);
+CREATE TABLE schedules (iid integer PRIMARY KEY, origin_location_iid integer, destination_location_iid integer);
+CREATE TABLE schedule_locations (iid serial PRIMARY KEY, schedule_iid integer, location_iid integer, stop integer, minutes integer,
+    arrival_public bigint, departure_public bigint, platform text, line text, path text, activity text,
+    engineering_allowance text, pathing_allowance text, performance_allowance text);
+CREATE TABLE flat_schedules (iid serial PRIMARY KEY, schedule_iid integer, uid text, category text, signalling_id text, headcode text,
+    power_type text, timing_load text, speed integer, operating_characteristics text, seating_class text, sleepers text,
+    reservations text, catering text, branding text, uic_code text, atoc_code text, start_date date,
+    actual_signalling_id text, trust_id text, current_variation integer, current_location integer, cancellation_location integer);
+CREATE TABLE flat_timing (flat_schedule_iid integer, schedule_location_iid integer, location_iid integer,
+    arrival_scheduled bigint, departure_scheduled bigint, pass_scheduled bigint);
+CREATE TABLE trust_movements (iid serial PRIMARY KEY, flat_schedule_iid integer, movement_type char(1), datetime_scheduled bigint,
+    datetime_actual bigint, stanox text, actual_platform text, actual_line text, actual_route text, actual_variation_status text,
+    actual_variation integer, actual_direction text, actual_source text);
+
+INSERT INTO locations (tiploc, name, stanox, crs)
+    SELECT 'TIP' || n, 'STATION ' || n, (70000+n)::text, 'S' || lpad(n::text, 2, '0')
+    FROM generate_series(1, :stations) n;
+
+-- Each service calls at stops stations in a row from somewhere random, some time between 04:00 and midnight
+CREATE TEMPORARY TABLE services AS
+    SELECT s, floor(random()*:stations)::integer AS origin, 240 + floor(random()*1200)::integer AS departs
+    FROM generate_series(1, :services) s;
+
+INSERT INTO schedules
+    SELECT s, 1 + origin, 1 + (origin + :stops - 1) % :stations FROM services;
+
+INSERT INTO schedule_locations (schedule_iid, location_iid, stop, minutes, platform, activity)
+    SELECT s, 1 + (origin + k) % :stations, k, departs + 4*k, (1 + floor(random()*12))::text,
+        CASE WHEN k = 0 THEN 'TB' WHEN k = :stops - 1 THEN 'TF' ELSE 'T ' END
+    FROM services, generate_series(0, :stops - 1) k;
+
+INSERT INTO flat_schedules (schedule_iid, uid, category, signalling_id, power_type, speed, operating_characteristics, atoc_code, start_date, current_variation)
+    SELECT s, 'C' || lpad(s::text, 5, '0'),
+        (ARRAY['OO', 'OO', 'OO', 'XX', 'EE', 'OU', 'BR'])[1 + floor(random()*7)::integer],
+        (1 + floor(random()*9))::text || (ARRAY['A', 'B', 'C', 'D', 'G', 'H'])[1 + floor(random()*6)::integer] || lpad(floor(random()*100)::text, 2, '0'),
+        (ARRAY['EMU', 'EMU', 'DMU', 'HST', 'E', 'D'])[1 + floor(random()*6)::integer],
+        (ARRAY[75, 100, 110, 125])[1 + floor(random()*4)::integer],
+        (ARRAY['', 'Q', 'D'])[1 + floor(random()*3)::integer],
+        (ARRAY['VT', 'GR', 'LM', 'SN', 'TL', 'CS', 'XR', 'GW'])[1 + floor(random()*8)::integer],
+        current_date - 1 + d, 0
+    FROM services, generate_series(0, :days - 1) d;
+
+-- Times are unix seconds in the session's time zone, as the client works them out
+INSERT INTO flat_timing
+    SELECT flat_schedules.iid, schedule_locations.iid, schedule_locations.location_iid,
+        CASE WHEN stop > 0 THEN extract(epoch FROM (start_date + make_interval(mins => minutes))::timestamptz)::bigint - 60 END,
+        CASE WHEN stop < :stops - 1 THEN extract(epoch FROM (start_date + make_interval(mins => minutes))::timestamptz)::bigint END,
+        NULL
+    FROM flat_schedules
+    INNER JOIN schedule_locations ON schedule_locations.schedule_iid=flat_schedules.schedule_iid;
+
+-- Everything that should have happened by now has, up to two minutes early or seven late
+INSERT INTO trust_movements (flat_schedule_iid, movement_type, datetime_scheduled, datetime_actual, stanox, actual_platform, actual_source)
+    SELECT flat_schedule_iid, movement_type, datetime_scheduled, datetime_scheduled + 60*(floor(random()*10)::integer - 2),
+        locations.stanox, schedule_locations.platform, 'A'
+    FROM flat_timing
+    INNER JOIN schedule_locations ON schedule_location_iid=schedule_locations.iid
+    INNER JOIN locations ON flat_timing.location_iid=locations.iid
+    CROSS JOIN LATERAL (VALUES ('A', arrival_scheduled), ('D', departure_scheduled)) AS movements(movement_type, datetime_scheduled)
+    WHERE datetime_scheduled < extract(epoch FROM now());
+
+UPDATE trust_movements SET
+    actual_variation = abs(datetime_actual - datetime_scheduled)/60,
+    actual_variation_status = CASE WHEN datetime_actual > datetime_scheduled THEN 'L' WHEN datetime_actual < datetime_scheduled THEN 'E' ELSE 'T' END;
+
+-- What the client shows as a service's latest running
+UPDATE flat_schedules SET actual_signalling_id=signalling_id, current_variation=latest.variation
+    FROM (SELECT DISTINCT ON (flat_schedule_iid) flat_schedule_iid, (datetime_actual - datetime_scheduled)/60 AS variation
+        FROM trust_movements ORDER BY flat_schedule_iid, datetime_actual DESC) AS latest
+    WHERE latest.flat_schedule_iid=flat_schedules.iid;
+
+ANALYZE;
@@ -0,0 +1,87 @@
+# Push refresh end to end, against a real database with notify.sql's triggers put on it:
+#   SWALLOW_TEST_DSN="dbname='swallow_test' options='-c search_path=synthetic'" python -m pytest test_notify.py
+# synthetic.sql makes a database to run it on. It writes a few movements with a datetime_scheduled of 0, and deletes them again
+
+import datetime, os, queue
+
+import pytest
+
+import client_curses as cc
+import export
+import queries
+
+DSN = os.environ.get("SWALLOW_TEST_DSN")
+pytestmark = pytest.mark.skipif(not DSN, reason="SWALLOW_TEST_DSN isn't set")
+
+@pytest.fixture
+def database(monkeypatch):
+    import psycopg2
+    # Put back afterwards, for whatever else runs in this process
+    monkeypatch.setitem(queries.config, "database-string", DSN)
+    monkeypatch.setattr(queries, "pool", None)
+    monkeypatch.setattr(queries, "crs_iids", {})
+    monkeypatch.setattr(cc, "location_cache", queries.LocationCache(cc.Location, 60))
+    connection = psycopg2.connect(DSN)
+    connection.autocommit = True
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "notify.sql")) as f, connection.cursor() as c:
+        c.execute(f.read())
+    yield connection
+    with connection.cursor() as c:
+        c.execute("DELETE FROM trust_movements WHERE datetime_scheduled=0;")
+    connection.close()
+    if queries.pool:
+        queries.pool.close()
+
+def board(crs, at):
+    buffer = export.ExportBoard(at - datetime.timedelta(minutes=60), 120, crs)
+    buffer.apply(buffer.fetch())
+    return buffer
+
+def boards(c):
+    # A station with a train at it, and another one somewhere else at the same time
+    c.execute("""SELECT locations.iid, crs, departure_scheduled FROM flat_timing
+        INNER JOIN locations ON flat_timing.location_iid=locations.iid
+        WHERE departure_scheduled IS NOT NULL AND crs IS NOT NULL LIMIT 1;""")
+    iid, crs, departs = c.fetchone()
+    c.execute("SELECT crs FROM locations WHERE crs IS NOT NULL AND iid<>%s AND stanox IS DISTINCT FROM (SELECT stanox FROM locations WHERE iid=%s) LIMIT 1;", [iid, iid])
+    other, = c.fetchone()
+    at = datetime.datetime.fromtimestamp(departs)
+    return board(crs, at), board(other, at)
+
+def delivered(listener, buffers):
+    payload = None
+    while payload is None:
+        payload = listener.notifications.get(timeout=10)
+    for buffer in buffers:
+        buffer.push_pending = False
+        buffer.notify(payload)
+    return payload
+
+def test_notifications_reach_affected_boards_only(database):
+    with database.cursor() as c:
+        here, elsewhere = boards(c)
+        stanox, = here.stanoxes
+        iid = next(iter(here.iids - elsewhere.iids))
+        listener = cc.NotificationListener(DSN, queries.config.get("notify-channel", "trust_movements"))
+        # It says when it's started listening
+        assert listener.notifications.get(timeout=10) is None
+
+        # A movement for a train on the board
+        c.execute("INSERT INTO trust_movements (flat_schedule_iid, movement_type, datetime_scheduled, datetime_actual, stanox) VALUES (%s, 'A', 0, 0, %s);", [iid, stanox])
+        delivered(listener, [here, elsewhere])
+        assert here.push_pending and not elsewhere.push_pending
+
+        # One for a train that isn't, at the station, which is only matched by stanox. That's only any use if it's the same type as locations.stanox
+        c.execute("INSERT INTO trust_movements (flat_schedule_iid, movement_type, datetime_scheduled, datetime_actual, stanox) VALUES (-1, 'A', 0, 0, %s);", [stanox])
+        payload = delivered(listener, [here, elsewhere])
+        assert payload["stanox"] == stanox, "trust_movements.stanox comes out as {!r}, locations.stanox as {!r}".format(payload["stanox"], stanox)
+        assert here.push_pending and not elsewhere.push_pending
+
+        # A schedule's live running changing
+        c.execute("UPDATE flat_schedules SET current_variation=current_variation WHERE iid=%s;", [iid])
+        assert delivered(listener, [here, elsewhere]) == {"flat_schedule_iid": iid}
+        assert here.push_pending and not elsewhere.push_pending
+
+        # And nothing else
+        with pytest.raises(queue.Empty):
+            listener.notifications.get(timeout=1)
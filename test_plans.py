@@ -0,0 +1,95 @@
+# The index advisor, on plans as EXPLAIN (FORMAT JSON) gives them, with nothing else needed:
+#   python -m pytest test_plans.py
+# and what it makes of the client's real queries, against a database synthetic.sql's made with no indexes but its keys:
+#   SWALLOW_TEST_DSN="dbname='swallow_test' options='-c search_path=synthetic'" python -m pytest test_plans.py
+
+import datetime, os
+
+import pytest
+
+import client_curses as cc
+import plans
+import queries
+
+DSN = os.environ.get("SWALLOW_TEST_DSN")
+
+def scan(relation, rows, removed=0, alias=None, condition=None, **rest):
+    node = {"Node Type": "Seq Scan", "Relation Name": relation, "Alias": alias or relation, "Actual Rows": rows, "Actual Loops": 1, "Rows Removed by Filter": removed}
+    if condition:
+        node["Filter"] = condition
+    node.update(rest)
+    return node
+
+def join(kind, condition, outer, inner):
+    key = {"Hash Join": "Hash Cond", "Merge Join": "Merge Cond", "Nested Loop": "Join Filter"}[kind]
+    if kind == "Hash Join":
+        inner = {"Node Type": "Hash", "Plans": [inner]}
+    outer, inner = dict(outer, **{"Parent Relationship": "Outer"}), dict(inner, **{"Parent Relationship": "Inner"})
+    return {"Node Type": kind, key: condition, "Plans": [outer, inner]}
+
+def suggested(plan, indexes={}):
+    return [(finding.relation, finding.detail.rsplit("(", 1)[-1].rstrip(")")) for finding in plans.findings(plan, indexes) if finding.ddl]
+
+# About half of trust_movements is arrivals, so that's hardly narrowed down at all
+ARRIVALS = scan("trust_movements", 400000, 400000, "ta", "(movement_type = 'A'::bpchar)")
+AT_STATION = scan("flat_timing", 120, 719880, condition="((location_iid = 5) AND (departure_scheduled >= 1704067200) AND (departure_scheduled <= 1704074400))")
+
+def test_terms():
+    assert plans.terms("(((location_iid = 5) OR (location_iid = 6)) AND (departure_scheduled >= 10))") == ["departure_scheduled >= 10"]
+    assert plans.terms("((location_iid = 5) OR (location_iid = 6))") == []
+    assert list(plans.comparisons("((ta.flat_schedule_iid = flat_timing.flat_schedule_iid) AND ((uid)::text = 'C00001'::text))")) == [
+        ("ta", "flat_schedule_iid", "="), ("flat_timing", "flat_schedule_iid", "="), (None, "uid", "=")]
+
+def test_ors_are_not_equalities():
+    either = scan("flat_timing", 120, 719880, condition="(((location_iid = 5) OR (location_iid = 6)) AND (departure_scheduled >= 1704067200))")
+    assert suggested(either) == [("flat_timing", "departure_scheduled")]
+    only = scan("flat_timing", 120, 719880, condition="((location_iid = 5) OR (location_iid = 6))")
+    assert plans.findings(only, {})[0].detail.endswith("nothing to index on")
+
+def test_join_conditions_stay_with_their_join():
+    # Two joins up it's joined on arrival_scheduled, and one up on flat_schedule_iid, but it's only hashed for the one it's under
+    everything = scan("flat_timing", 720000)
+    stations = join("Hash Join", "(flat_timing.location_iid = locations.iid)", everything, scan("locations", 100))
+    schedules = join("Hash Join", "(flat_timing.flat_schedule_iid = flat_schedules.iid)", stations, scan("flat_schedules", 60000))
+    plan = join("Hash Join", "(ta.datetime_scheduled = flat_timing.arrival_scheduled)", ARRIVALS, schedules)
+    assert suggested(plan, {"flat_schedules": [["iid"]]}) == [("trust_movements", "movement_type, datetime_scheduled"), ("flat_timing", "location_iid")]
+
+def test_hashed_side_keeps_its_own_index():
+    # Narrowed down to a station and a window by itself, an index on what it's hashed for would only be in the way of that
+    plan = join("Hash Join", "(ta.datetime_scheduled = flat_timing.arrival_scheduled)", ARRIVALS, AT_STATION)
+    assert ("flat_timing", "location_iid, departure_scheduled") in suggested(plan)
+    # Looked up by a nested loop it's what it's joined on that matters
+    departures = scan("trust_movements", 2, 799998, "td", "(movement_type = 'D'::bpchar)", **{"Actual Loops": 120})
+    plan = join("Nested Loop", "(td.flat_schedule_iid = flat_timing.flat_schedule_iid)", AT_STATION, departures)
+    assert ("trust_movements", "movement_type, flat_schedule_iid") in suggested(plan)
+
+def test_one_index_for_both_joins():
+    departures = scan("trust_movements", 400000, 400000, "td", "(movement_type = 'D'::bpchar)")
+    inner = join("Hash Join", "((td.flat_schedule_iid = flat_timing.flat_schedule_iid))", departures, AT_STATION)
+    plan = join("Hash Join", "((ta.flat_schedule_iid = flat_timing.flat_schedule_iid) AND (ta.datetime_scheduled = flat_timing.arrival_scheduled))", ARRIVALS, inner)
+    assert [columns for relation, columns in suggested(plan) if relation == "trust_movements"] == ["movement_type, flat_schedule_iid, datetime_scheduled"]
+
+def test_index_names_fit():
+    names = [plans.create_index("trust_movements", ["movement_type", "flat_schedule_iid", last]).split()[6] for last in ["datetime_scheduled", "datetime_actual"]]
+    assert all(len(name) <= 63 for name in names) and names[0] != names[1]
+
+@pytest.mark.skipif(not DSN, reason="SWALLOW_TEST_DSN isn't set")
+def test_board(monkeypatch, tmp_path):
+    import export
+    monkeypatch.setitem(queries.config, "database-string", DSN)
+    monkeypatch.setattr(queries, "pool", None)
+    monkeypatch.setattr(queries, "crs_iids", {})
+    monkeypatch.setattr(cc, "location_cache", queries.LocationCache(cc.Location, 60))
+    monkeypatch.setattr(plans, "plan_log", plans.PlanLog(str(tmp_path / "plans.jsonl")))
+    buffer = export.ExportBoard(datetime.datetime.now() - datetime.timedelta(minutes=10), 120, "S01")
+    try:
+        buffer.apply(buffer.fetch())
+        records = plans.explain_buffer(buffer)
+    finally:
+        if queries.pool:
+            queries.pool.close()
+    ddl = {finding["ddl"] for record in records for finding in record["findings"]}
+    assert "CREATE INDEX CONCURRENTLY IF NOT EXISTS flat_timing_location_iid_departure_scheduled_idx ON flat_timing (location_iid, departure_scheduled);" in ddl
+    assert plans.create_index("trust_movements", ["movement_type", "flat_schedule_iid", "datetime_scheduled"]) in ddl
+    assert "CREATE INDEX CONCURRENTLY IF NOT EXISTS trust_movements_flat_schedule_iid_datetime_actual_idx ON trust_movements (flat_schedule_iid, datetime_actual);" in ddl
+    assert len(plans.plan_log.history()) == len(records)
@@ -0,0 +1,97 @@
+# SharedSnapshots between processes on this host, with nothing else needed:
+#   python -m pytest test_shared_snapshots.py
+
+import os, signal, subprocess, sys, time
+
+import pytest
+
+import bench
+import client_curses as cc
+import queries
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+KEY, PARAMS = ("board", "S01", 120), (0, 0, 0)
+
+# Claims the lock, says so, then hangs on to it
+HOLDER = """
+import sys, time
+import client_curses as cc
+shared = cc.SharedSnapshots(sys.argv[1], 30, float(sys.argv[2]))
+assert shared.claim({!r}, {!r})
+print("claimed", flush=True)
+time.sleep(60)
+""".format(KEY, PARAMS)
+
+@pytest.fixture
+def holder(tmp_path):
+    processes = []
+    def start(lock_timeout):
+        process = subprocess.Popen([sys.executable, "-c", HOLDER, str(tmp_path), str(lock_timeout)], cwd=HERE, stdout=subprocess.PIPE, text=True)
+        assert process.stdout.readline().strip() == "claimed"
+        processes.append(process)
+        return process
+    yield start
+    for process in processes:
+        process.kill()
+        process.send_signal(signal.SIGCONT)
+        process.wait()
+
+def test_killed_holder(tmp_path, holder):
+    shared = cc.SharedSnapshots(str(tmp_path), 30, 30)
+    process = holder(30)
+    assert not shared.claim(KEY, PARAMS)
+    # The kernel lets go of a dead process's lock, there's no waiting for lock_timeout
+    process.kill()
+    process.wait()
+    assert shared.claim(KEY, PARAMS)
+
+def test_stopped_holder(tmp_path, holder):
+    shared = cc.SharedSnapshots(str(tmp_path), 30, 1)
+    process = holder(1)
+    process.send_signal(signal.SIGSTOP)
+    assert not shared.claim(KEY, PARAMS)
+    # Still holding it, but for longer than lock_timeout
+    time.sleep(1.5)
+    assert shared.claim(KEY, PARAMS)
+
+def test_columnar_locations(tmp_path, monkeypatch):
+    # Another client's location_cache won't have had these iids in it. A fresh one, the real one's put back after
+    monkeypatch.setattr(cc, "location_cache", queries.LocationCache(cc.Location, 60))
+    rows = bench.synthetic_rows(50, start=1704088800)
+    iids = {row[bench.POSITIONS[path]] for row in rows for path in cc.LOCATION_COLUMNS} - {None}
+    for iid in iids:
+        cc.location_cache.locations[iid] = cc.Location("TIP{}".format(iid), "STATION {}".format(iid), str(70000+iid), None)
+    shared = cc.SharedSnapshots(str(tmp_path), 30, 30)
+    shared.put(KEY, cc.ColumnarData(cc.BOARD_SCHEMA, rows), PARAMS)
+    cc.location_cache.locations.clear()
+    cc.location_cache.fresh.clear()
+
+    data = shared.get(KEY, PARAMS).data
+    origin = rows[0][bench.POSITIONS["origin"]]
+    assert data.data[0]["origin"]["name"] == "STATION {}".format(origin)
+    assert data.data[0]["here"]["stanox"] == "70001"
+
+def test_prune(tmp_path):
+    shared = cc.SharedSnapshots(str(tmp_path), 30, 30)
+    # An earlier window's snapshot and lock, a lock that's still held, and a put that never finished
+    shared.put(KEY, [], (1, 0, 0))
+    assert shared.claim(KEY, (1, 0, 0))
+    shared.release(KEY, (1, 0, 0))
+    assert shared.claim(KEY, (2, 0, 0))
+    with open(shared.filename(KEY, (1, 0, 0), ".snap.1"), "w"):
+        pass
+    long_ago = time.time()-60
+    for name in os.listdir(str(tmp_path)):
+        os.utime(os.path.join(str(tmp_path), name), (long_ago, long_ago))
+
+    shared.pruned = 0
+    shared.put(KEY, [], PARAMS)
+    kept = [shared.filename(KEY, PARAMS, ".snap"), shared.filename(KEY, (2, 0, 0), ".lock")]
+    assert sorted(os.listdir(str(tmp_path))) == sorted(os.path.basename(path) for path in kept)
+
+def test_failed_put(tmp_path):
+    shared = cc.SharedSnapshots(str(tmp_path), 30, 30)
+    with pytest.raises(Exception):
+        # Can't be pickled
+        shared.put(KEY, lambda: None, PARAMS)
+    assert os.listdir(str(tmp_path)) == []